@@ -0,0 +1,104 @@
+"""
+Compares the float32 and the dynamic int8 (quantize_int8) models on a sample set: error rate and
+real-time factor of the streaming decoding, with the settings of a worker configuration.
+
+The sample set is a jsonlines file with one {"audio": <16 kHz wav>, "sentence": <reference>} per line,
+or a Kaldi data directory whose wav.scp (utterance id, wav path) and text (utterance id, reference)
+are turned into that file, e.g. the test set of AISHELL-1 for the "zh" models:
+
+    python local/compare_quantized.py -c conf/samaple_worker.yaml data/aishell/test
+    python local/compare_quantized.py -c conf/samaple_worker.yaml data/samples.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from local.whispergstserver.simul_whisper.transcriber.config import AlignAttConfig
+from local.whispergstserver.simul_whisper.transcriber.segment_loader import SegmentLoader
+from local.whispergstserver.simul_whisper.transcriber.simul_whisper import PaddedAlignAttWhisper
+from local.whispergstserver.simul_whisper.whisper.audio import SAMPLE_RATE
+
+
+def edit_distance(r, h):
+    d = np.zeros((len(r) + 1, len(h) + 1), dtype=np.int32)
+    d[:, 0] = np.arange(len(r) + 1)
+    d[0, :] = np.arange(len(h) + 1)
+    for i in range(1, len(r) + 1):
+        for j in range(1, len(h) + 1):
+            d[i, j] = min(d[i - 1, j - 1] + (r[i - 1] != h[j - 1]), d[i, j - 1] + 1, d[i - 1, j] + 1)
+    return d[len(r), len(h)]
+
+
+def units(text, unit):
+    text = re.sub(r"<\|[^|]*\|>", "", text)
+    return list(text.replace(" ", "")) if unit == "char" else text.split()
+
+
+def kaldi_sample_list(data_dir):
+    """Writes the jsonlines sample set of the utterances of data_dir that have both a wav and a reference"""
+    def read_table(name):
+        with open(os.path.join(data_dir, name), encoding="utf-8") as f:
+            return dict(line.rstrip("\n").split(maxsplit=1) for line in f if line.strip())
+    wavs, texts = read_table("wav.scp"), read_table("text")
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        for utt_id in sorted(wavs.keys() & texts.keys()):
+            f.write(json.dumps({"audio": wavs[utt_id], "sentence": texts[utt_id]}, ensure_ascii=False) + "\n")
+    return f.name
+
+
+def evaluate(cfg, unit):
+    model = PaddedAlignAttWhisper(cfg)
+    loader = SegmentLoader(cfg)
+    errors, n_ref, compute_time, audio_time = 0, 0, 0.0, 0.0
+    for i in range(len(loader)):
+        segments, reference = loader[i]
+        session = model.new_session()
+        tokens = []
+        start = time.time()
+        with torch.no_grad():
+            for segment, is_last in segments:
+                result = model.infer(session, segment, is_last=is_last)
+                if isinstance(result, torch.Tensor):
+                    tokens += result.tolist()
+        compute_time += time.time() - start
+        audio_time += segments.audio.shape[0] / SAMPLE_RATE
+        ref, hyp = units(reference, unit), units(model.tokenizer.decode(tokens), unit)
+        errors += edit_distance(ref, hyp)
+        n_ref += len(ref)
+    return 100.0 * errors / max(1, n_ref), compute_time / max(audio_time, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Error rate and speed of the float32 and int8 models")
+    parser.add_argument("-c", "--conf", required=True, help="YAML worker configuration, its model_config is used")
+    parser.add_argument("--unit", default="char", choices=["char", "word"], help="CER for languages without spaces, WER otherwise")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("samples", help="jsonlines file with the audio and sentence of every sample, or a Kaldi data directory")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    with open(args.conf) as f:
+        model_config = yaml.safe_load(f)["model_config"]
+    options = {key: value for key, value in model_config.items() if key in AlignAttConfig.__dataclass_fields__}
+    options["eval_data_path"] = kaldi_sample_list(args.samples) if os.path.isdir(args.samples) else args.samples
+
+    metric = "CER" if args.unit == "char" else "WER"
+    results = {}
+    for name, quantize in [("float32", False), ("int8", True)]:
+        options["quantize_int8"] = quantize
+        results[name] = evaluate(AlignAttConfig(**options), args.unit)
+        print("{}: {} {:.2f}%, RTF {:.3f}".format(name, metric, *results[name]))
+    print("int8 - float32: {} {:+.2f}, RTF x{:.2f}".format(
+        metric, results["int8"][0] - results["float32"][0], results["int8"][1] / results["float32"][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Exports a Whisper checkpoint to the ONNX graphs run by the onnxruntime backend (backend: onnxruntime,
+onnx_dir: <output dir> in the model_config of a worker):
+
+    encoder.onnx          mel (1, n_mels, n_frames) -> audio_features
+    decoder_prefill.onnx  tokens (1, n_tokens), audio_features and the cached self-attention keys/values
+                          -> logits, keys/values, cross-attention keys/values, alignment layer weights
+    decoder_step.onnx     tokens (1, 1), the cached self-attention and cross-attention keys/values
+                          -> logits, keys/values, alignment layer weights
+    model.json            the model dimensions and alignment heads
+
+    python local/export_onnx.py exp/whisper/medium.pt exp/whisper/medium-onnx
+"""
+import argparse
+import inspect
+import json
+import os
+
+import torch
+from torch import nn
+
+from local.whispergstserver.simul_whisper.whisper import load_model
+from local.whispergstserver.simul_whisper.whisper.model import TextDecoder
+
+
+class CachedDecoder(nn.Module):
+    """
+    The TextDecoder with its keys/values as explicit inputs and outputs: the self-attention ones are
+    (n_layer, 1, n_cached, n_state) and grow by the number of tokens, the cross-attention ones are
+    computed from audio_features by the prefill graph and passed back to the step graph.
+    The cross-attention weights of the layers in `align_layers` are returned as well
+    (see Whisper.set_attention_outputs).
+    """
+    def __init__(self, decoder: TextDecoder, align_layers):
+        super().__init__()
+        self.decoder = decoder
+        self.align_layers = align_layers
+
+    def run(self, tokens, past_keys, past_values, cross_keys, cross_values):
+        offset = past_keys.shape[2]
+        x = self.decoder.token_embedding(tokens) + self.decoder.positional_embedding[offset : offset + tokens.shape[1]]
+        keys, values, attention = [], [], []
+        for i, block in enumerate(self.decoder.blocks):
+            attn = block.attn
+            h = block.attn_ln(x)
+            keys.append(torch.cat([past_keys[i], attn.key(h)], dim=1))
+            values.append(torch.cat([past_values[i], attn.value(h)], dim=1))
+            wv, _ = attn.qkv_attention(attn.query(h), keys[-1], values[-1], self.decoder.mask[offset:])
+            x = x + attn.out(wv)
+
+            cross_attn = block.cross_attn
+            wv, weights = cross_attn.qkv_attention(cross_attn.query(block.cross_attn_ln(x)), cross_keys[i], cross_values[i])
+            x = x + cross_attn.out(wv)
+            if i in self.align_layers:
+                attention.append(weights)
+            x = x + block.mlp(block.mlp_ln(x))
+        x = self.decoder.ln(x)
+        logits = x @ torch.transpose(self.decoder.token_embedding.weight, 0, 1)
+        return logits, torch.stack(keys), torch.stack(values), attention
+
+
+class DecoderPrefill(CachedDecoder):
+    def forward(self, tokens, audio_features, past_keys, past_values):
+        cross_keys = torch.stack([block.cross_attn.key(audio_features) for block in self.decoder.blocks])
+        cross_values = torch.stack([block.cross_attn.value(audio_features) for block in self.decoder.blocks])
+        logits, keys, values, attention = self.run(tokens, past_keys, past_values, cross_keys, cross_values)
+        return (logits, keys, values, cross_keys, cross_values, *attention)
+
+
+class DecoderStep(CachedDecoder):
+    def forward(self, tokens, past_keys, past_values, cross_keys, cross_values):
+        logits, keys, values, attention = self.run(tokens, past_keys, past_values, cross_keys, cross_values)
+        return (logits, keys, values, *attention)
+
+
+def export(module, args, path, input_names, output_names, dynamic_axes, opset):
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False # the graphs are traced, see dynamic_axes
+    torch.onnx.export(module, args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **options)
+    print(f"wrote {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Whisper checkpoint for the onnxruntime backend")
+    parser.add_argument("--opset", type=int, default=14, help="ONNX opset version")
+    parser.add_argument("model_path", help="the checkpoint, as model_path in the worker configuration")
+    parser.add_argument("output_dir", help="where the graphs and model.json are written, onnx_dir in the worker configuration")
+    args = parser.parse_args()
+
+    model_name = os.path.basename(args.model_path).replace(".pt", "")
+    model = load_model(name=model_name, device="cpu", download_root=os.path.dirname(args.model_path)).float().eval()
+    dims = model.dims
+    alignment_heads = model.alignment_heads.to_dense()
+    align_layers = sorted(set(model.alignment_heads.indices()[0].tolist()))
+    model.set_attention_outputs(align_layers)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    n_frames = 2 * dims.n_audio_ctx
+    mel = torch.zeros(1, dims.n_mels, n_frames)
+    tokens = torch.zeros(1, 3, dtype=torch.long)
+    token = torch.zeros(1, 1, dtype=torch.long)
+    past = torch.zeros(dims.n_text_layer, 1, 2, dims.n_text_state)
+    weight_names = [f"weights_{layer}" for layer in align_layers]
+    weight_axes = {name: {2: "n_tokens", 3: "n_audio"} for name in weight_names}
+    cache_axes = {"past_keys": {2: "n_cached"}, "past_values": {2: "n_cached"},
+                  "keys": {2: "n_total"}, "values": {2: "n_total"}}
+
+    with torch.no_grad():
+        audio_features = model.encoder(mel)
+        cross = torch.zeros(dims.n_text_layer, 1, dims.n_audio_ctx, dims.n_audio_state)
+        export(model.encoder, (mel,), os.path.join(args.output_dir, "encoder.onnx"),
+               ["mel"], ["audio_features"],
+               {"mel": {2: "n_frames"}, "audio_features": {1: "n_audio"}}, args.opset)
+        export(DecoderPrefill(model.decoder, align_layers), (tokens, audio_features, past, past),
+               os.path.join(args.output_dir, "decoder_prefill.onnx"),
+               ["tokens", "audio_features", "past_keys", "past_values"],
+               ["logits", "keys", "values", "cross_keys", "cross_values"] + weight_names,
+               {"tokens": {1: "n_tokens"}, "audio_features": {1: "n_audio"}, "logits": {1: "n_tokens"},
+                "cross_keys": {2: "n_audio"}, "cross_values": {2: "n_audio"}, **cache_axes, **weight_axes}, args.opset)
+        export(DecoderStep(model.decoder, align_layers), (token, past, past, cross, cross),
+               os.path.join(args.output_dir, "decoder_step.onnx"),
+               ["tokens", "past_keys", "past_values", "cross_keys", "cross_values"],
+               ["logits", "keys", "values"] + weight_names,
+               {"cross_keys": {2: "n_audio"}, "cross_values": {2: "n_audio"}, **cache_axes, **weight_axes}, args.opset)
+
+    with open(os.path.join(args.output_dir, "model.json"), "w") as f:
+        json.dump({"dims": dims.__dict__, "alignment_heads": alignment_heads.tolist()}, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ Modified on Oct 20, 2024
 import wave
 import os
 import _thread as thread
+import threading
 from collections import OrderedDict
 import common
 import re
@@ -31,7 +32,6 @@ import requests
 import time
 import sys
 import json
-import numpy as np
 
 # others
 import wer
@@ -44,15 +44,78 @@ import torch
 
 from local.whispergstserver.simul_whisper.transcriber.config import AlignAttConfig
 from local.whispergstserver.simul_whisper.transcriber.segment_loader import SegmentWrapper
+from local.whispergstserver.simul_whisper.transcriber.audio_buffer import AudioBuffer
+from local.whispergstserver.simul_whisper.transcriber.controller import SegmentLengthController
+from local.whispergstserver.simul_whisper.transcriber.vad import EnergyVAD
+from local.whispergstserver.simul_whisper.transcriber.profiler import ChunkTimer
 from local.whispergstserver.simul_whisper.transcriber.simul_whisper import PaddedAlignAttWhisper, DEC_PAD
 from local.whispergstserver.simul_whisper.whisper.audio import N_FFT, HOP_LENGTH, SAMPLE_RATE
 
-from io import StringIO
-log_stream = StringIO()
-stream_handler = logging.StreamHandler(log_stream)
+# the audio format of the audio buffer, other content types are decoded to it
+NATIVE_CAPS = "audio/x-raw,format=S16LE,rate=16000,channels=1,layout=interleaved"
+
+def is_native_pcm(content_type):
+    '''True when the content type is missing or already 16 kHz 16-bit mono PCM'''
+    if not content_type:
+        return True
+    media_type, _, attr_string = content_type.replace(";", ",").partition(",")
+    if media_type.strip() not in ["audio/x-raw", "audio/x-raw-int"]:
+        return False
+    attributes = {"rate": "16000", "format": "S16LE", "channels": "1"}
+    for (key, _, value) in [p.partition("=") for p in attr_string.split(",") if p.strip()]:
+        attributes[key.strip()] = re.sub(r"^\(\w+\)", "", value.strip())
+    return attributes["rate"] == "16000" and attributes["format"] == "S16LE" and attributes["channels"] == "1"
+
+
+class StreamingAudioDecoder(object):
+    '''
+    Decodes compressed audio (Opus, Speex, FLAC or anything else decodebin handles) and PCM of other
+    rates and formats to 16 kHz 16-bit mono PCM as the chunks arrive. The decoded bytes are passed to
+    on_pcm from a GStreamer streaming thread.
+    '''
+    def __init__(self, content_type, on_pcm):
+        self.on_pcm = on_pcm
+        self.pipeline = Gst.parse_launch(
+            "appsrc name=src ! decodebin ! audioconvert ! audioresample ! {} ! "
+            "appsink name=sink emit-signals=true sync=false".format(NATIVE_CAPS))
+        self.appsrc = self.pipeline.get_by_name("src")
+        caps = Gst.Caps.from_string(content_type.replace("audio/x-raw-int", "audio/x-raw").replace(";", ","))
+        if caps is not None:
+            self.appsrc.set_property("caps", caps)
+        else:
+            logger.warning("Cannot parse content type {}, detecting the format from the data".format(content_type))
+        self.pipeline.get_by_name("sink").connect("new-sample", self._on_new_sample)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _on_new_sample(self, sink):
+        buf = sink.emit("pull-sample").get_buffer()
+        self.on_pcm(buf.extract_dup(0, buf.get_size()))
+        return Gst.FlowReturn.OK
+
+    def push(self, data):
+        self.appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(data))
+
+    def finish(self, timeout=10):
+        '''Decodes the rest of the pushed data, blocks until it has all been passed to on_pcm'''
+        self.appsrc.emit("end-of-stream")
+        msg = self.pipeline.get_bus().timed_pop_filtered(timeout * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        self.close()
+        if msg is None:
+            raise RuntimeError("audio decoding did not finish in {} seconds".format(timeout))
+        if msg.type == Gst.MessageType.ERROR:
+            err, debug = msg.parse_error()
+            raise RuntimeError("audio decoding failed: {} ({})".format(err.message, debug))
+
+    def close(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
 
 class DecoderPipeline(object):
-    def __init__(self, sys_conf={}, port=8899, args=None):
+    def __init__(self, sys_conf={}, port=8899, args=None, speech2text=None):
+        '''
+        speech2text: (optional) an already loaded PaddedAlignAttWhisper to share with other pipelines,
+            each pipeline keeps its own stream session
+        '''
         logger.info("Creating decoder using conf: {}".format(sys_conf))
         
         self.decoder_timeout = str(int(sys_conf.get("decoder-timeout", 10)) + 2)
@@ -62,24 +125,66 @@ class DecoderPipeline(object):
         self.full_result_handler = None
         self.eos_handler = None
         self.error_handler = None
+        self.chunk_handler = None
+        self.audio_decoder = None
+        # False when the audio of the request goes through audio_decoder, data arriving after it was closed is dropped
+        self.native_pcm = True
+        # guards audio_decoder, which is pushed to by the receiving thread and closed by the decoding thread
+        self.audio_decoder_lock = threading.Lock()
         self.request_id = "<undefined>"
         self.user_id = "<undefined>"
-        self.whole_data = b""
+        # the raw audio of the whole request, only kept for __save_waveform
+        self.keep_recording = sys_conf.get("keep-recording", False)
+        self.whole_data = []
         self.obj = object
         self.port = int(port)
         self.prompt = ""
         self.transcript = ""
         self.model_config = sys_conf["model_config"]
-        self._init_model(self.model_config)
+        # with adaptive-segment-length, the chunks grow up to max-segment-length seconds while decoding is slower than target-rtf
+        self.segment_controller = None
+        if sys_conf.get("adaptive-segment-length", False):
+            self.segment_controller = SegmentLengthController(
+                self.model_config["segment_length"],
+                sys_conf.get("max-segment-length", 4.0),
+                target_rtf=sys_conf.get("target-rtf", 0.8),
+            )
+        # when decoding falls behind, the pending chunks are decoded together, up to this many seconds at a time
+        self.max_coalesced_chunk = sys_conf.get("max-coalesced-chunk", 5.0)
+        # with use-vad, the chunks without speech are buffered as silence and not decoded
+        self.vad = None
+        if sys_conf.get("use-vad", False):
+            self.vad = EnergyVAD(
+                margin=sys_conf.get("vad-margin", 10.0),
+                min_energy=sys_conf.get("vad-min-energy", -50.0),
+                hangover=sys_conf.get("vad-hangover", 1),
+            )
+        self.skipped_chunks = 0
+        # with collect-timing, the final result gets a timing block with the stages of every chunk
+        self.collect_timing = sys_conf.get("collect-timing", False)
+        self.chunk_timings = []
+        self.ingest_time = 0.0
+        self.scheduled_time = None
+        self._init_model(self.model_config, speech2text)
+        # the audio is decoded on a thread of its own, so that receiving frames never waits for the model
+        self.audio_lock = threading.Lock()
+        self.decode_lock = threading.RLock() # held while decoding, _on_error resets the session under it
+        self.decode_condition = threading.Condition()
+        self.decode_pending = False
+        self.final_pending = False
+        # bumped whenever the queued decoding is dropped, a decoding pass of an older generation is stale
+        self.generation = 0
+        thread.start_new_thread(self._decode_loop, ())
         logger.info("Listen on Port: {}".format(self.port))
     
-    def _init_model(self, model_config):
+    def _init_model(self, model_config, speech2text=None):
         '''
         if_ckpt_path: align with the whisper model. e.g., using small.pt for whisper small
         segment_length: chunk length, in seconds
         frame_threshold: threshold for the attention-guided decoding, in frames
         buffer_len: the lengths for the context buffer, in seconds
         min_seg_len: transcibe only when the context buffer is larger than this threshold. Useful when the segment_length is small
+        the other fields of AlignAttConfig are optional, their defaults and descriptions are in transcriber/config.py
         '''
         model_path = model_config["model_path"]
         if_ckpt_path = model_config["if_ckpt_path"]
@@ -88,6 +193,9 @@ class DecoderPipeline(object):
         buffer_len = model_config["buffer_len"]
         min_seg_len = model_config["min_seg_len"]
         language = model_config["language"]
+        # the optional fields, missing ones take the defaults of AlignAttConfig
+        required = ("model_path", "if_ckpt_path", "segment_length", "frame_threshold", "buffer_len", "min_seg_len", "language")
+        options = {key: value for key, value in model_config.items() if key in AlignAttConfig.__dataclass_fields__ and key not in required}
         
         # https://github.com/backspacetg/simul_whisper/blob/main/transcribe.py
         # config
@@ -99,20 +207,32 @@ class DecoderPipeline(object):
             buffer_len=buffer_len, 
             min_seg_len=min_seg_len,
             if_ckpt_path=if_ckpt_path,
+            **options
         )
         # stt model
-        self.speech2text = PaddedAlignAttWhisper(cfg, stream_handler)
+        self.speech2text = speech2text if speech2text is not None else PaddedAlignAttWhisper(cfg)
+        self.session = self.speech2text.new_session()
         ## warmup
         #audio_path = "demo_wavs/A01_u254_t9_p4_i15_1-1_20220928.wav"
         #segmented_audio = SegmentWrapper(audio_path=audio_path, segment_length=segment_length)
         #for seg_id, (seg, is_last) in enumerate(segmented_audio):
-        #    self.speech2text.infer(seg, is_last)
+        #    self.speech2text.infer(self.session, seg, is_last)
         
         # https://github.com/backspacetg/simul_whisper/blob/main/simul_whisper/transcriber/segment_loader.py#L36
         frames_to_read = int((segment_length * SAMPLE_RATE) / HOP_LENGTH)
         self.samples_to_read = frames_to_read * HOP_LENGTH
         self.samples_in_chunk = self.samples_to_read + N_FFT - HOP_LENGTH
         self.buffer_len = self.samples_in_chunk - self.samples_to_read
+        max_segment_length = self.segment_controller.max_length if self.segment_controller is not None else segment_length
+        self.max_chunk_samples = max(self._chunk_samples(max_segment_length), int(self.max_coalesced_chunk * SAMPLE_RATE))
+        # the session keeps the chunks of the last buffer_len seconds as views of this buffer. compacting copies
+        # to a new buffer, so the capacity only sets how often that happens
+        self.audio_buffer = AudioBuffer(2 * (int(buffer_len * SAMPLE_RATE) + self.max_chunk_samples))
+
+    def _chunk_samples(self, segment_length):
+        '''segment_length seconds of new samples plus the overlap with the previous chunk'''
+        frames_to_read = int((segment_length * SAMPLE_RATE) / HOP_LENGTH)
+        return frames_to_read * HOP_LENGTH + N_FFT - HOP_LENGTH
 
     def _on_partial_result(self, hyp):
         logger.info("{}: Getting partial result: {}".format(self.request_id, hyp))
@@ -138,6 +258,8 @@ class DecoderPipeline(object):
                 result_json["result"]["hypotheses"][rs] = result[rs]
 
         result_json["result"]["final"] = True
+        if "timing" in result:
+            result_json["timing"] = result["timing"]
         full_result_json = json.dumps(result_json)
         logger.info("{}: Getting FULL final result: {}".format(self.request_id, full_result_json))
         if self.full_result_handler: 
@@ -161,21 +283,44 @@ class DecoderPipeline(object):
     def finish_request(self):
         logger.info("{}: Resetting decoder state".format(self.request_id))
         self.request_id = "<undefined>"
-        self.speech2text.refresh_segment(complete=True)
+        self._drop_pending_decoding()
+        with self.decode_lock:
+            self._close_audio_decoder()
+            self.session.reset(complete=True)
         # self._on_eos("send EOS inside decoder without socket")
         logger.info("{}: Resetting decoder state OK".format(self.request_id))
 
-    def init_request(self, request_id, user_id):
-        self.request_id = request_id
-        self.user_id = user_id
-        self.whole_data = b""
-        self.partial_data = b""
-        logger.info("{}: Initializing request".format(self.request_id))
-        logger.info("{}: connect to decoder server".format(self.request_id))
-        self.transcript = ""
-        self.tmp_transcript = ""
-        self.audio_buffer = torch.tensor([])
-        self.speech2text.refresh_segment(complete=True)
+    def init_request(self, request_id, user_id, content_type=None):
+        '''
+        content_type: the GStreamer caps or MIME type of the audio, 16 kHz 16-bit mono PCM when not given
+        '''
+        self._drop_pending_decoding()
+        # a stale decoding pass may still hold the lock, it must not see the state of the new request
+        with self.decode_lock:
+            self.request_id = request_id
+            self.user_id = user_id
+            self.whole_data = []
+            logger.info("{}: Initializing request".format(self.request_id))
+            logger.info("{}: connect to decoder server".format(self.request_id))
+            self.transcript = ""
+            self.tmp_transcript = ""
+            if self.segment_controller is not None:
+                self.segment_controller.reset()
+            if self.vad is not None:
+                self.vad.reset()
+            self.skipped_chunks = 0
+            self.chunk_timings = []
+            self.ingest_time = 0.0
+            self._close_audio_decoder()
+            with self.audio_lock:
+                self.audio_buffer.reset()
+            self.session.reset(complete=True)
+            self.native_pcm = is_native_pcm(content_type)
+            if not self.native_pcm:
+                logger.info("{}: Decoding {} to 16 kHz PCM".format(self.request_id, content_type))
+                audio_decoder = StreamingAudioDecoder(content_type, self._on_decoded_audio)
+                with self.audio_decoder_lock:
+                    self.audio_decoder = audio_decoder
         logger.info("{}: Initialized request".format(self.request_id))
 
     def process_prompt(self, full_prompt):
@@ -184,66 +329,220 @@ class DecoderPipeline(object):
 
     def process_data(self, data):
         logger.debug('{}: Pushing buffer of size {} and type {} to pipeline'.format(self.request_id, len(data), type(data)))
-        self.whole_data += data
-        self.partial_data += data
-        speech = np.frombuffer(self.partial_data, dtype='int16').astype(np.float16) / 32767.0
-        speech = torch.from_numpy(speech)
-        logger.debug(f'{self.request_id}: Audio buffer size {self.audio_buffer.shape} adn speech size {speech.shape}')
-        self.audio_buffer = torch.cat((self.audio_buffer, speech))
-        self.partial_data = b""
+        start_time = time.perf_counter()
+        if self.native_pcm:
+            self._write_pcm(data)
+        else:
+            with self.audio_decoder_lock:
+                if self.audio_decoder is not None:
+                    self.audio_decoder.push(data)
+                else:
+                    logger.info('{}: Dropping audio received after the audio decoder was closed'.format(self.request_id))
+        self.ingest_time += time.perf_counter() - start_time
         
         logger.debug('{}: Pushing buffer done'.format(self.request_id))
+
+    def _write_pcm(self, data):
+        if self.keep_recording:
+            self.whole_data.append(data)
+        with self.audio_lock:
+            self.audio_buffer.write(data)
+        logger.debug(f'{self.request_id}: Audio buffer size {len(self.audio_buffer)}')
+
+    def _on_decoded_audio(self, data):
+        # called from the GStreamer thread, the chunk is decoded whenever enough audio has been decoded
+        self._write_pcm(data)
+        self.schedule_decoding()
+
+    def _take_audio_decoder(self):
+        '''Detach the audio decoder, after that no more data is pushed to it'''
+        with self.audio_decoder_lock:
+            audio_decoder, self.audio_decoder = self.audio_decoder, None
+        return audio_decoder
+
+    def _close_audio_decoder(self):
+        audio_decoder = self._take_audio_decoder()
+        if audio_decoder is not None:
+            audio_decoder.close()
        
-    def recv_and_rec_data(self, is_final=False):
+    def schedule_decoding(self, is_final=False):
+        '''
+        Queue the decoding of the received audio on the decoding thread, followed by end_request if is_final.
+        Requests that are still queued when the thread gets to them are served by one decoding pass.
+        '''
+        with self.decode_condition:
+            if not self.decode_pending:
+                self.scheduled_time = time.perf_counter()
+            self.decode_pending = True
+            self.final_pending = self.final_pending or is_final
+            self.decode_condition.notify()
+
+    def _drop_pending_decoding(self):
+        with self.decode_condition:
+            self.decode_pending = False
+            self.final_pending = False
+            self.generation += 1
+
+    def _decode_loop(self):
+        while True:
+            with self.decode_condition:
+                while not self.decode_pending:
+                    self.decode_condition.wait()
+                is_final = self.final_pending
+                generation = self.generation
+                self.decode_pending = False
+                self.final_pending = False
+            with self.decode_lock:
+                if generation != self.generation:
+                    # the request was cancelled or finished while waiting for the lock
+                    continue
+                try:
+                    audio_decoder = self._take_audio_decoder() if is_final else None
+                    if audio_decoder is not None:
+                        audio_decoder.finish()
+                    self.recv_and_rec_data(is_final=is_final, generation=generation)
+                    if is_final and generation == self.generation:
+                        self.end_request()
+                except Exception as e:
+                    logger.exception("{}: Decoding failed".format(self.request_id))
+                    if generation == self.generation:
+                        self._on_error(str(e), "decoding")
+
+    def lag(self):
+        '''Seconds of received audio that have not been decoded yet'''
+        return max(0, len(self.audio_buffer) - self.buffer_len) / SAMPLE_RATE
+
+    def recv_and_rec_data(self, is_final=False, generation=None):
+        '''
+        Decode the buffered audio. The results of a pass whose `generation` is no longer current
+        belong to a cancelled request and are dropped.
+        '''
+        if generation is None:
+            generation = self.generation
         logger.debug(f'{self.request_id}: The parameter is_final is {is_final}')
-        logger.debug(f'{self.request_id}: Audio buffer size {self.audio_buffer.shape} and sample in chunk {self.samples_in_chunk}')
-        # Get the audio from the audio buffer 
-        if not is_final and len(self.audio_buffer) >= self.samples_in_chunk:
-            audio_buffer = self.audio_buffer
-            self.audio_buffer = self.audio_buffer[-self.buffer_len:]
-        elif is_final and len(self.audio_buffer) > 0:
-            audio_buffer = self.audio_buffer
-            self.audio_buffer = torch.tensor([])
-        else:
-            return
-        
-        log_stream.truncate(0)
-        log_stream.seek(0)
-        
+        samples_in_chunk = self.samples_in_chunk
+        if self.segment_controller is not None:
+            samples_in_chunk = self._chunk_samples(self.segment_controller.segment_length)
+        logger.debug(f'{self.request_id}: Audio buffer size {len(self.audio_buffer)} and sample in chunk {samples_in_chunk}, lag {self.lag():.2f}s')
+        # Get the audio from the audio buffer, all the pending chunks at once if decoding is behind
+        while generation == self.generation:
+            with self.audio_lock:
+                pending = len(self.audio_buffer)
+                if pending > self.max_chunk_samples:
+                    audio_buffer = self.audio_buffer.read(self.max_chunk_samples, keep=self.buffer_len)
+                    is_last = False
+                elif not is_final and pending >= samples_in_chunk:
+                    audio_buffer = self.audio_buffer.read(pending, keep=self.buffer_len)
+                    is_last = False
+                elif is_final and pending > 0:
+                    audio_buffer = self.audio_buffer.read(pending)
+                    is_last = True
+                else:
+                    return
+            self._decode_chunk(audio_buffer, is_last, generation)
+
+    def _start_chunk_timer(self):
+        timer = ChunkTimer(sync=self.speech2text.device.type == "cuda")
+        # the audio received and the time waited for the decoding thread since the last chunk
+        ingest_time, self.ingest_time = self.ingest_time, 0.0
+        timer.add("ingest", ingest_time)
+        with self.decode_condition:
+            scheduled_time, self.scheduled_time = self.scheduled_time, None
+        if scheduled_time is not None:
+            timer.add("queue_wait", time.perf_counter() - scheduled_time)
+        return timer
+
+    def _decode_chunk(self, audio_buffer, is_final, generation):
+        timer = self._start_chunk_timer() if self.collect_timing else None
+        try:
+            self._decode_timed_chunk(audio_buffer, is_final, generation, timer)
+        finally:
+            if timer is not None:
+                self.chunk_timings.append(timer.as_dict())
+
+    def _decode_timed_chunk(self, audio_buffer, is_final, generation, timer):
+        # the last chunk is always decoded, it commits the tokens held back at the end of the previous one
+        if not is_final and self.vad is not None:
+            start_time = time.perf_counter()
+            is_speech = self.vad.is_speech(audio_buffer[self.buffer_len:])
+            if timer is not None:
+                timer.add("vad", time.perf_counter() - start_time)
+            if not is_speech:
+                logger.debug(f'{self.request_id}: no speech in chunk, skipping decoding')
+                self.skipped_chunks += 1
+                with torch.no_grad():
+                    self.speech2text.skip_silence(self.session, audio_buffer)
+                return
+
+        # tokens that are still tentative in this chunk, used for the in-progress partial result
+        tentative_tokens = []
+        def on_token(event):
+            if not event.committed:
+                tentative_tokens.append(event.token)
+
+        start_time = time.time()
         with torch.no_grad():
-            results = self.speech2text.infer(audio_buffer, is_last=is_final)
-        
-        log_data = log_stream.getvalue()
-        
-        pattern = r'current token.*?\((.*?)\)'
-        results_tmp = re.findall(pattern, log_data)
+            results = self.speech2text.infer(self.session, audio_buffer, is_last=is_final, on_token=on_token, timer=timer)
+        if generation != self.generation:
+            logger.info(f'{self.request_id}: dropping the results of a cancelled request')
+            return
+        if not is_final:
+            self._update_segment_length(time.time() - start_time, (len(audio_buffer) - self.buffer_len) / SAMPLE_RATE)
         
         logger.debug(f'{self.request_id}: results {results}')
-        logger.debug(f'{self.request_id}: results_tmp {results_tmp}')
+        logger.debug(f'{self.request_id}: tentative tokens {tentative_tokens}')
         
+        start_time = time.perf_counter()
         if results is not None and len(results) > 0:
             text = self.speech2text.tokenizer.decode(results)
             text = re.sub("<\|notimestamps\|>", "", text)
             self.transcript += text
-            self._on_partial_result(self.transcript)
-        elif len(results_tmp) > 0:
-            transcript_tmp = " ".join(results_tmp)
+            partial_result = self.transcript
+        elif len(tentative_tokens) > 0:
+            transcript_tmp = self.speech2text.tokenizer.decode(tentative_tokens)
             transcript_tmp = re.sub("<\|notimestamps\|>", "", transcript_tmp)
-            self._on_partial_result(self.transcript + transcript_tmp)
-        
-        log_stream.truncate(0)
-        log_stream.seek(0)
+            partial_result = self.transcript + transcript_tmp
+        else:
+            return
+        if timer is not None:
+            timer.add("detokenize", time.perf_counter() - start_time)
+        self._on_partial_result(partial_result)
         
+    def _update_segment_length(self, compute_time, audio_duration):
+        if self.segment_controller is None or not self.segment_controller.update(compute_time, audio_duration):
+            return
+        segment_length = self.segment_controller.segment_length
+        rtf = self.segment_controller.rtf
+        logger.info("{}: Real-time factor {:.2f}, segment length set to {}s".format(self.request_id, rtf, segment_length))
+        if self.chunk_handler:
+            self.chunk_handler(segment_length, rtf)
+
     def end_request(self):
         logger.info("{}: Ending Request to pipeline".format(self.request_id))
         logger.info("{}: Got transcript: >>{}<<".format(self.request_id, self.transcript))
+        if self.vad is not None:
+            logger.info("{}: Skipped {} chunks without speech".format(self.request_id, self.skipped_chunks))
+        if self.speech2text.encoder_scheduler is not None:
+            logger.info("{}: Encoder {}".format(self.request_id, self.speech2text.encoder_scheduler.report()))
+        if self.speech2text.decoder_scheduler is not None:
+            logger.info("{}: Decoder {}".format(self.request_id, self.speech2text.decoder_scheduler.report()))
         logger.info("{}: Ended Request to pipeline".format(self.request_id))
         transcript = " ".join(self.transcript.split())
         result = {}
         result["transcript"] = transcript
+        if self.collect_timing:
+            result["timing"] = self._timing_summary()
         self._on_full_final_result(result)
         # self.__save_waveform(os.getcwd() + '/wavs/' + self.user_id + '.wav')
-        self.whole_data = b""
+        self.whole_data = []
+
+    def _timing_summary(self):
+        '''The per-chunk records, in ms, and their sums over the request'''
+        total = {}
+        for chunk in self.chunk_timings:
+            for name, value in chunk.items():
+                total[name] = round(total.get(name, 0) + value, 3)
+        return {"chunks": self.chunk_timings, "total": total}
 
     def __save_text(self, filename, transcript):
         with open(filename, "w") as fn:
@@ -253,7 +552,7 @@ class DecoderPipeline(object):
         try:
             f = wave.open(filename, 'wb')
             f.setparams((1,2,16000,0,'NONE','NONE'))
-            f.writeframes(self.whole_data)
+            f.writeframes(b"".join(self.whole_data))
             f.close()
         except IOError as e:
             logger.info(e)
@@ -270,8 +569,31 @@ class DecoderPipeline(object):
     def set_error_handler(self, handler):
         self.error_handler = handler
 
-    def cancel(self):
+    def set_chunk_handler(self, handler):
+        self.chunk_handler = handler
+
+    def stop(self):
+        '''Drop the queued decoding and the results of the chunk being decoded, without waiting for it'''
+        logger.info("{}: Stopping the decoding".format(self.request_id))
+        self._drop_pending_decoding()
+
+    def cancel(self, abort=None):
+        '''
+        Drop the queued decoding and reset the session once the chunk being decoded is done.
+        abort: a threading.Event, once it is set cancel stops waiting for that chunk and returns False,
+            the session is then left as it is
+        '''
         logger.info("{}: Sending EOS to pipeline in order to cancel processing".format(self.request_id)) 
-        self.speech2text.refresh_segment(complete=True)
+        self.stop()
+        while not self.decode_lock.acquire(timeout=0.1):
+            if abort is not None and abort.is_set():
+                logger.warning("{}: Gave up waiting for the decoding to stop".format(self.request_id))
+                return False
+        try:
+            self._close_audio_decoder()
+            self.session.reset(complete=True)
+        finally:
+            self.decode_lock.release()
         logger.info("{}: Cancelled pipeline".format(self.request_id))
+        return True
 
@@ -49,11 +49,44 @@ class Application(tornado.web.Application):
         ]
         tornado.web.Application.__init__(self, handlers, **settings)
         self.available_workers = set()
+        # the connections of every worker process, which opens one per slot (concurrent stream)
+        self.worker_connections = {}
         self.status_listeners = set()
         self.num_requests_processed = 0
 
+    def add_worker(self, worker):
+        self.worker_connections.setdefault(worker.worker_id, set()).add(worker)
+        self.available_workers.add(worker)
+
+    def remove_worker(self, worker):
+        self.available_workers.discard(worker)
+        connections = self.worker_connections.get(worker.worker_id, set())
+        connections.discard(worker)
+        if not connections:
+            self.worker_connections.pop(worker.worker_id, None)
+
+    def free_slots(self, worker_id):
+        return len(self.worker_connections.get(worker_id, set()) & self.available_workers)
+
+    def pop_worker(self):
+        """
+        Takes a free worker connection from the worker process with the most free slots, so that the
+        streams are spread over the processes. Raises KeyError when no worker is available.
+        """
+        if not self.available_workers:
+            raise KeyError("no worker available")
+        worker = max(self.available_workers, key=lambda w: self.free_slots(w.worker_id))
+        self.available_workers.discard(worker)
+        return worker
+
+    def worker_status(self):
+        """The slots, connected slots and free slots of every worker process"""
+        return {worker_id: dict(slots=max(worker.slots for worker in connections), connected=len(connections), free=self.free_slots(worker_id))
+                for worker_id, connections in self.worker_connections.items()}
+
     def send_status_update_single(self, ws):
-        status = dict(num_workers_available=len(self.available_workers), num_requests_processed=self.num_requests_processed)
+        status = dict(num_workers_available=len(self.available_workers), num_requests_processed=self.num_requests_processed,
+                      workers=self.worker_status())
         try:
             ws.write_message(json.dumps(status))
         except:
@@ -121,7 +154,7 @@ class HttpChunkedRecognizeHandler(tornado.web.RequestHandler):
         #Waiter thread for final hypothesis:
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) 
         try:
-            self.worker = self.application.available_workers.pop()
+            self.worker = self.application.pop_worker()
             self.application.send_status_update()
             logging.info("%s: Using worker %s" % (self.id, self.__str__()))
             self.worker.set_client_socket(self)
@@ -245,13 +278,17 @@ class WorkerSocketHandler(tornado.websocket.WebSocketHandler):
 
     def open(self):
         self.client_socket = None
-        self.application.available_workers.add(self)
-        logging.info("New worker available " + self.__str__())
+        # a worker process serving several streams connects once per slot with the same worker-id
+        self.worker_id = self.get_argument("worker-id", str(id(self)), True)
+        self.slots = int(self.get_argument("slots", "1", True))
+        self.application.add_worker(self)
+        logging.info("New worker available " + self.__str__() + " (process %s, %d free of %d slots)" % (
+            self.worker_id, self.application.free_slots(self.worker_id), self.slots))
         self.application.send_status_update()
 
     def on_close(self):
         logging.info("Worker " + self.__str__() + " leaving")
-        self.application.available_workers.discard(self)
+        self.application.remove_worker(self)
         if self.client_socket:
             self.client_socket.close()
         self.application.send_status_update()
@@ -288,10 +325,12 @@ class DecoderSocketHandler(tornado.websocket.WebSocketHandler):
         self.content_id = self.get_argument("content-id", "none", True)
         self.prompt = self.get_argument("prompt", "none", True)
         self.prons_length = self.get_argument("prons_length", "none", True)
+        # delta-partials=true: partial results carry the length of the unchanged prefix and the new tail instead of the whole transcript
+        self.delta_partials = self.get_argument("delta-partials", "false", True).lower() in ["true", "1", "yes"]
         logging.info("%s: prompt : %s" % (self.id, self.prompt))
         self.worker = None
         try:
-            self.worker = self.application.available_workers.pop()
+            self.worker = self.application.pop_worker()
             self.application.send_status_update()
             logging.info("%s: Using worker %s" % (self.id, self.__str__()))
             self.worker.set_client_socket(self)
@@ -301,7 +340,8 @@ class DecoderSocketHandler(tornado.websocket.WebSocketHandler):
                 logging.info("%s: Using content type: %s" % (self.id, content_type))
 
             self.worker.write_message(json.dumps(dict(id=self.id, content_type=content_type, 
-                                      prompt=self.prompt, user_id=self.user_id, content_id=self.content_id, prons_length=self.prons_length)))
+                                      prompt=self.prompt, user_id=self.user_id, content_id=self.content_id, prons_length=self.prons_length,
+                                      delta_partials=self.delta_partials)))
         except KeyError:
             logging.warn("%s: No worker available for client request" % self.id)
             event = dict(status=common.STATUS_NOT_AVAILABLE, message="No decoder available, try again later")
@@ -0,0 +1,66 @@
+import collections
+import itertools
+import logging
+
+import tornado.gen
+import tornado.ioloop
+import tornado.process
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+
+logger = logging.getLogger(__name__)
+
+
+class PostProcessor(object):
+    """
+    One post-processor subprocess. Requests are written as soon as they are submitted, so several can be
+    in flight, and the answers, which the process writes in order, are read asynchronously and matched to
+    the pending requests first in, first out.
+    """
+    def __init__(self, command, terminator=b"\n"):
+        STREAM = tornado.process.Subprocess.STREAM
+        self.process = tornado.process.Subprocess(command, shell=True, stdin=STREAM, stdout=STREAM)
+        self.terminator = terminator
+        self.pending = collections.deque()
+        self.reading = False
+
+    def submit(self, request_id, request):
+        if not self.reading:
+            self.reading = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.read_loop)
+        future = Future()
+        self.pending.append((request_id, future))
+        self.process.stdin.write(request.encode("utf-8") + self.terminator)
+        return future
+
+    @tornado.gen.coroutine
+    def read_loop(self):
+        while True:
+            try:
+                response = yield self.process.stdout.read_until(self.terminator)
+            except StreamClosedError as e:
+                logger.error("Post-processor exited with %d requests pending" % len(self.pending))
+                while self.pending:
+                    self.pending.popleft()[1].set_exception(e)
+                return
+            request_id, future = self.pending.popleft()
+            logger.debug("Post-processor answered request %d" % request_id)
+            future.set_result(response.decode("utf-8"))
+
+
+class PostProcessorPool(object):
+    """
+    A pool of post-processor subprocesses running the same command. Every request goes to the process with
+    the fewest pending requests. Requests and answers end with `terminator`: a newline for the
+    post-processor, which reads and writes one line of text per request, and a blank line for the full
+    post-processor, which reads and writes one JSON result per request.
+    The pool must be created and used on the IOLoop that serves its pipes.
+    """
+    def __init__(self, command, size=1, terminator=b"\n"):
+        self.processes = [PostProcessor(command, terminator) for _ in range(max(1, size))]
+        self.request_ids = itertools.count()
+
+    def process(self, request):
+        """Returns a Future of the post-processed text, including the terminator"""
+        processor = min(self.processes, key=lambda p: len(p.pending))
+        return processor.submit(next(self.request_ids), request)
@@ -0,0 +1,105 @@
+from typing import Dict, List, Tuple
+
+import torch
+
+from ..whisper.timing import median_filter
+
+
+class AlignmentTracker:
+    """
+    Cross-attention of the alignment heads, one row per token in the KV cache of the decoder.
+
+    The rows are written into a preallocated buffer as the decoder layers run, together with the running
+    mean and variance of every frame over the rows, so the most attended frame of the latest token can be
+    computed without rebuilding the whole token x frame matrix. The result is the same as normalizing the
+    matrix over the tokens, median-filtering it along the frames, averaging the heads and taking the last row.
+    The rows of a cached prefix are kept with it (see trim), they attend to the audio of the chunk that fed it.
+    """
+    def __init__(self, align_source: Dict[int, List[Tuple[int, int]]], num_align_heads: int, max_tokens: int, filter_width: int = 7):
+        # gather indices: the heads to take from each layer and their rank among the alignment heads
+        self.head_ids = {layer: torch.tensor([h for _, h in heads]) for layer, heads in align_source.items()}
+        self.head_ranks = {layer: torch.tensor([r for r, _ in heads]) for layer, heads in align_source.items()}
+        self.num_layers = len(align_source)
+        self.num_align_heads = num_align_heads
+        self.max_tokens = max_tokens
+        self.filter_width = filter_width
+        self.rows = None
+        self.reset()
+
+    def reset(self):
+        self.length = 0
+        self.n_frames = 0
+        self.pending_layers = 0
+
+    def trim(self, n: int):
+        """Keep the rows of the first `n` tokens, as KVCache.trim keeps their keys/values, and recompute their statistics"""
+        self.length = min(n, self.length)
+        self.pending_layers = 0
+        if self.length > 0:
+            kept = self.rows[:, :self.length, :self.n_frames].double()
+            self.mean[:, :self.n_frames] = kept.mean(dim=1)
+            self.m2[:, :self.n_frames] = ((kept - self.mean[:, None, :self.n_frames]) ** 2).sum(dim=1)
+
+    def allocate(self, like: torch.Tensor, n_frames: int):
+        """Make room for `n_frames` frames, the kept rows have no weight on the frames added since they were fed"""
+        if self.rows is None or self.rows.shape[2] < n_frames or self.rows.dtype != like.dtype or self.rows.device != like.device:
+            rows = like.new_zeros(self.num_align_heads, self.max_tokens, n_frames)
+            mean = torch.zeros(self.num_align_heads, n_frames, dtype=torch.float64, device=like.device)
+            m2 = torch.zeros_like(mean) # sum of squared differences from the mean
+            if self.length > 0:
+                n_kept = min(self.n_frames, n_frames)
+                rows[:, :self.length, :n_kept] = self.rows[:, :self.length, :n_kept]
+                mean[:, :n_kept] = self.mean[:, :n_kept]
+                m2[:, :n_kept] = self.m2[:, :n_kept]
+            self.rows, self.mean, self.m2 = rows, mean, m2
+        elif self.length > 0 and n_frames > self.n_frames:
+            self.rows[:, :self.length, self.n_frames:n_frames] = 0
+            self.mean[:, self.n_frames:n_frames] = 0
+            self.m2[:, self.n_frames:n_frames] = 0
+        self.n_frames = n_frames
+
+    def update(self, layer_rank: int, attention: torch.Tensor):
+        """
+        attention: the float32 softmax weights of the cross-attention of a decoder layer,
+        B*num_head*token_len*audio_len, as returned for the alignment layers (see Whisper.set_attention_outputs)
+        """
+        weights = attention[0, self.head_ids[layer_rank]] # align_heads_in_layer*token_len*audio_len
+        n_tokens, n_frames = weights.shape[1:]
+        if self.pending_layers == 0:
+            self.allocate(weights, n_frames)
+        heads = self.head_ranks[layer_rank]
+        end = self.length + n_tokens
+        self.rows[heads, self.length:end, :n_frames] = weights
+
+        # merge the statistics of the new rows into the running ones (Chan et al.)
+        weights = weights.double()
+        new_mean = weights.mean(dim=1)
+        new_m2 = ((weights - new_mean[:, None, :]) ** 2).sum(dim=1)
+        if self.length == 0:
+            self.mean[heads, :n_frames] = new_mean
+            self.m2[heads, :n_frames] = new_m2
+        else:
+            mean, m2 = self.mean[heads, :n_frames], self.m2[heads, :n_frames]
+            delta = new_mean - mean
+            self.mean[heads, :n_frames] = mean + delta * n_tokens / end
+            self.m2[heads, :n_frames] = m2 + new_m2 + delta ** 2 * self.length * n_tokens / end
+        self.pending_layers += 1
+        if self.pending_layers == self.num_layers:
+            # every layer with alignment heads has written the rows of this forward pass
+            self.pending_layers = 0
+            self.length = end
+
+    def normalized(self, start: int, end: int, content_len: int):
+        """Normalized, median-filtered and head-averaged attention of rows [start, end), cut to the content frames"""
+        rows = self.rows[:, start:end, :self.n_frames]
+        if self.length > 1:
+            mean = self.mean[:, None, :self.n_frames].to(rows.dtype)
+            # frames that every row attends to equally have no spread
+            std = (self.m2[:, None, :self.n_frames] / self.length).sqrt().clamp_min(1e-6).to(rows.dtype)
+            rows = (rows - mean) / std
+        # else a single row has nothing to be normalized against, its weights are used as they are
+        rows = median_filter(rows, self.filter_width) # from whisper.timing
+        return rows.mean(dim=0)[:, :content_len]
+
+    def most_attended_frame(self, content_len: int):
+        return torch.argmax(self.normalized(self.length - 1, self.length, content_len)[-1], dim=0)
@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+
+
+class AudioBuffer:
+    """
+    Append-only buffer for the incoming 16-bit PCM of a stream, converted to float as it is written.
+
+    Samples are appended at `end` and the samples from `start` on make up the next chunk, which is read
+    as a view with `read()`. The samples are written into a block of `capacity` samples. When it is full,
+    the pending samples are copied to the front of a newly allocated block, and the old block is freed once
+    no segment of a session or chunk being decoded views it any more. So a block is allocated every
+    `capacity` minus pending samples, rather than a tensor per chunk, and samples are never overwritten.
+    """
+    def __init__(self, capacity: int):
+        self.buffer = torch.empty(capacity, dtype=torch.float32)
+        self.reset()
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def write(self, data: bytes):
+        samples = np.frombuffer(data, dtype=np.int16)
+        n = samples.shape[0]
+        if self.end + n > self.buffer.shape[0]:
+            self.compact(n)
+        np.divide(samples, np.float32(32767.0), out=self.buffer[self.end:self.end + n].numpy(), dtype=np.float32)
+        self.end += n
+
+    def compact(self, n: int):
+        """Move the pending samples to a new buffer with room for `n` more, the old one may still be viewed"""
+        # larger than the capacity only when the chunks are not read in time
+        buffer = torch.empty(max(self.buffer.shape[0], 2 * (len(self) + n)), dtype=self.buffer.dtype)
+        buffer[:len(self)] = self.buffer[self.start:self.end]
+        self.buffer = buffer
+        self.end = len(self)
+        self.start = 0
+
+    def read(self, n: int, keep: int = 0) -> torch.Tensor:
+        """A view of the next `n` pending samples; the last `keep` of them also start the next chunk"""
+        n = min(n, len(self))
+        chunk = self.buffer[self.start:self.start + n]
+        self.start += max(0, n - keep)
+        return chunk
@@ -0,0 +1,223 @@
+import json
+import os
+import logging
+import threading
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from ..whisper import load_model
+from ..whisper.model import KVCache, ModelDimensions
+from .compiled_step import CompiledDecoderStep
+from .config import AlignAttConfig
+from .quantization import load_quantized_model
+
+logger = logging.getLogger(__name__)
+
+# the softmax cross-attention of the decoder layers that have alignment heads, (layer_rank, weights)
+LayerAttention = List[Tuple[int, torch.Tensor]]
+
+
+class InferenceBackend:
+    """
+    What PaddedAlignAttWhisper needs from a Whisper model: encode a mel, run the decoder on new tokens
+    with a KV cache, and return the cross-attention weights of the layers with alignment heads.
+
+    dims: the ModelDimensions of the model
+    alignment_heads: sparse bool mask (n_text_layer, n_text_head) of the alignment heads
+    device: where the tensors passed to and returned by the backend live
+    """
+    dims: ModelDimensions
+    alignment_heads: torch.Tensor
+    device: torch.device
+
+    def align_layers(self):
+        return sorted(set(self.alignment_heads.indices()[0].tolist()))
+
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        """mel: float32 (batch, n_mels, n_frames); returns the audio features (batch, n_frames // 2, n_audio_state)"""
+        raise NotImplementedError
+
+    def new_kv_cache(self, n_ctx: int):
+        """An empty cache for one stream, with `offset`, `trim(n)` and `reset()` like KVCache"""
+        raise NotImplementedError
+
+    def decode(self, tokens: torch.Tensor, audio_features: torch.Tensor, kv_cache) -> Tuple[torch.Tensor, LayerAttention]:
+        """
+        tokens: (1, n_tokens), the tokens after the cached ones
+        Returns the float32 logits (1, n_tokens, n_vocab) and the float32 cross-attention weights of the
+        alignment layers, each B*num_head*n_tokens*audio_len. The cache is advanced by n_tokens.
+        """
+        raise NotImplementedError
+
+    def share_cross_attention(self, source, target):
+        """Let the cache `target` reuse the cross-attention keys/values that `source` holds for the same audio features, if possible"""
+        pass
+
+    def decode_batch(self, tokens: torch.Tensor, audio_features: List[torch.Tensor], kv_caches: List) -> Tuple[torch.Tensor, List[LayerAttention]]:
+        """
+        One token per row, every row with its own audio features and cache.
+        Returns the logits (batch, 1, n_vocab) and the cross-attention of every row.
+        """
+        logits, attentions = [], []
+        for i, kv_cache in enumerate(kv_caches):
+            row_logits, row_attention = self.decode(tokens[i : i + 1], audio_features[i], kv_cache)
+            logits.append(row_logits)
+            attentions.append(row_attention)
+        return torch.cat(logits), attentions
+
+
+class TorchBackend(InferenceBackend):
+    """
+    The PyTorch model, optionally int8-quantized or cast to compute_dtype. The cross-attention weights are
+    collected by forward hooks on the alignment layers, per thread since streams may decode concurrently.
+    With fused_attention, the other attention layers run the fused kernel and compute no weights.
+    With compile_decoder_step, the single-token steps of a stream run through a traced CompiledDecoderStep.
+    """
+    def __init__(self, cfg: AlignAttConfig):
+        model_name = os.path.basename(cfg.model_path).replace(".pt", "")
+        model_path = os.path.dirname(cfg.model_path)
+        if cfg.quantize_int8:
+            self.model = load_quantized_model(model_name, model_path, cfg.quantized_model_path)
+        else:
+            self.model = load_model(name=model_name, download_root=model_path)
+        # the encoder and decoder run in compute_dtype, the log-mel, CIF, alignment statistics and logits stay float32
+        self.dtype = getattr(torch, cfg.compute_dtype)
+        if self.dtype != torch.float32:
+            if cfg.quantize_int8:
+                raise ValueError("quantize_int8 runs the Linear layers in int8, it cannot be combined with compute_dtype")
+            self.model.to(self.dtype)
+        self.dims = self.model.dims
+        self.alignment_heads = self.model.alignment_heads
+        self.device = self.model.device
+        self.layer_ranks = self.align_layers()
+        if self.model.set_attention_outputs(self.layer_ranks, cfg.fused_attention):
+            logger.info("using scaled_dot_product_attention outside of the alignment layers")
+        elif cfg.fused_attention:
+            logger.warning("scaled_dot_product_attention needs torch >= 2.0, fused_attention is ignored")
+
+        self.compiled_step = None
+        if cfg.compile_decoder_step:
+            self.compiled_step = CompiledDecoderStep(self.model.decoder, self.layer_ranks, self.dims.n_audio_ctx, cfg.compiled_decoder_path)
+            if cfg.truncate_encoder:
+                logger.warning("compile_decoder_step is traced for the full audio length, the truncated chunks of truncate_encoder decode on the eager modules")
+
+        self.collected = threading.local()
+        def make_layer_hook(layer_rank):
+            def layer_hook(module, net_input, net_output):
+                # net_output[1]: B*num_head*token_len*audio_len, or a list of 1*num_head*1*audio_len
+                # with one entry per row for a batched step (see MultiHeadAttention.ragged_forward)
+                self.collected.attention.append((layer_rank, net_output[1]))
+            return layer_hook
+        for layer_rank in self.layer_ranks:
+            self.model.decoder.blocks[layer_rank].cross_attn.register_forward_hook(make_layer_hook(layer_rank))
+
+    def encode(self, mel):
+        return self.model.encoder(mel.to(self.dtype))
+
+    def new_kv_cache(self, n_ctx):
+        return KVCache(n_ctx)
+
+    def share_cross_attention(self, source, target):
+        target.cross.update(source.cross)
+
+    def decode(self, tokens, audio_features, kv_cache):
+        if self.compiled_step is not None and self.compiled_step.usable(tokens, kv_cache):
+            logits, weights = self.compiled_step(tokens, kv_cache)
+            return logits.float(), list(zip(self.layer_ranks, weights))
+        self.collected.attention = []
+        logits = self.model.decoder(tokens, audio_features, kv_cache=kv_cache)
+        return logits.float(), self.collected.attention
+
+    def decode_batch(self, tokens, audio_features, kv_caches):
+        self.collected.attention = []
+        logits = self.model.decoder(tokens, audio_features, kv_cache=kv_caches)
+        attentions = [[] for _ in kv_caches]
+        for layer_rank, weights in self.collected.attention:
+            for row, row_weights in zip(attentions, weights):
+                row.append((layer_rank, row_weights))
+        return logits.float(), attentions
+
+
+class OrtKVCache:
+    """
+    The keys/values of one stream for the ONNX decoder graphs, as numpy arrays: the self-attention
+    ones (n_text_layer, 1, offset, n_text_state) and the cross-attention ones of the current audio.
+    """
+    def __init__(self, n_layer: int, n_state: int):
+        self.empty = np.zeros((n_layer, 1, 0, n_state), dtype=np.float32)
+        self.reset()
+
+    @property
+    def offset(self):
+        return self.keys.shape[2]
+
+    def trim(self, n: int):
+        """Keep the first `n` positions of the self-attention cache; cross-attention entries are dropped"""
+        self.keys = self.keys[:, :, :n] if n > 0 else self.empty
+        self.values = self.values[:, :, :n] if n > 0 else self.empty
+        self.cross_keys = None
+        self.cross_values = None
+
+    def reset(self):
+        self.trim(0)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    The graphs written by local/export_onnx.py, run on CPU by ONNX Runtime:
+    encoder.onnx (mel -> audio features), decoder_prefill.onnx (the tokens of a new chunk, which also
+    computes the cross-attention keys/values of its audio) and decoder_step.onnx (one token, with the
+    cross-attention keys/values from the cache). model.json has the dimensions and alignment heads.
+    """
+    def __init__(self, cfg: AlignAttConfig):
+        import onnxruntime
+
+        if cfg.quantize_int8 or cfg.compute_dtype != "float32":
+            raise ValueError("the onnxruntime backend runs the exported float32 graphs, quantize_int8 and compute_dtype apply to the torch backend")
+        with open(os.path.join(cfg.onnx_dir, "model.json")) as f:
+            metadata = json.load(f)
+        self.dims = ModelDimensions(**metadata["dims"])
+        self.alignment_heads = torch.tensor(metadata["alignment_heads"], dtype=torch.bool).to_sparse()
+        self.device = torch.device("cpu")
+        self.layer_ranks = self.align_layers() # the order of the attention outputs of the decoder graphs
+
+        def load(name):
+            path = os.path.join(cfg.onnx_dir, name)
+            logger.info(f"loading {path}")
+            return onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.encoder = load("encoder.onnx")
+        self.prefill = load("decoder_prefill.onnx")
+        self.step = load("decoder_step.onnx")
+
+    def encode(self, mel):
+        features, = self.encoder.run(None, {"mel": mel.float().numpy()})
+        return torch.from_numpy(features)
+
+    def new_kv_cache(self, n_ctx):
+        return OrtKVCache(self.dims.n_text_layer, self.dims.n_text_state)
+
+    def decode(self, tokens, audio_features, kv_cache):
+        inputs = {"tokens": tokens.numpy(), "past_keys": kv_cache.keys, "past_values": kv_cache.values}
+        if kv_cache.cross_keys is None:
+            inputs["audio_features"] = audio_features.numpy()
+            logits, kv_cache.keys, kv_cache.values, kv_cache.cross_keys, kv_cache.cross_values, *weights = self.prefill.run(None, inputs)
+        else:
+            inputs["cross_keys"] = kv_cache.cross_keys
+            inputs["cross_values"] = kv_cache.cross_values
+            logits, kv_cache.keys, kv_cache.values, *weights = self.step.run(None, inputs)
+        attention = [(layer_rank, torch.from_numpy(w)) for layer_rank, w in zip(self.layer_ranks, weights)]
+        return torch.from_numpy(logits), attention
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "onnxruntime": OnnxRuntimeBackend,
+}
+
+
+def load_backend(cfg: AlignAttConfig) -> InferenceBackend:
+    if cfg.backend not in BACKENDS:
+        raise ValueError(f"unknown backend {cfg.backend}, one of {', '.join(BACKENDS)}")
+    return BACKENDS[cfg.backend](cfg)
@@ -0,0 +1,101 @@
+import os
+import logging
+from typing import List
+
+import torch
+from torch import nn
+
+from ..whisper.model import KVCache, TextDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class StaticDecoderStep(nn.Module):
+    """
+    One decoder step of one stream with fixed shapes, for tracing: the token (1, 1), its position
+    `offset` as a (1,) tensor, and the self-attention keys/values as the full n_ctx buffers of a KVCache.
+    The keys/values of the token are written into the buffers in place and the positions past it are
+    masked, so the shapes do not change from one step to the next. The cross-attention keys/values are
+    the ones the prefill stored in the cache. Returns the logits and the cross-attention weights of the
+    layers in `align_layers` (see Whisper.set_attention_outputs).
+    """
+    def __init__(self, decoder: TextDecoder, align_layers: List[int]):
+        super().__init__()
+        self.decoder = decoder
+        self.align_layers = align_layers
+        self.n_layer = len(decoder.blocks)
+        self.register_buffer("positions", torch.arange(decoder.positional_embedding.shape[0]), persistent=False)
+
+    def forward(self, tokens, offset, *caches):
+        n = self.n_layer
+        keys, values, cross_keys, cross_values = caches[:n], caches[n : 2 * n], caches[2 * n : 3 * n], caches[3 * n :]
+        x = self.decoder.token_embedding(tokens) + self.decoder.positional_embedding.index_select(0, offset)
+        mask = torch.zeros(1, self.positions.shape[0], dtype=x.dtype, device=x.device)
+        mask = mask.masked_fill(self.positions > offset, float("-inf"))
+        attention = []
+        for i, block in enumerate(self.decoder.blocks):
+            attn = block.attn
+            h = block.attn_ln(x)
+            keys[i].index_copy_(1, offset, attn.key(h))
+            values[i].index_copy_(1, offset, attn.value(h))
+            wv, _ = attn.qkv_attention(attn.query(h), keys[i], values[i], mask)
+            x = x + attn.out(wv)
+
+            cross_attn = block.cross_attn
+            wv, weights = cross_attn.qkv_attention(cross_attn.query(block.cross_attn_ln(x)), cross_keys[i], cross_values[i])
+            x = x + cross_attn.out(wv)
+            if i in self.align_layers:
+                attention.append(weights)
+            x = x + block.mlp(block.mlp_ln(x))
+        x = self.decoder.ln(x)
+        logits = x @ torch.transpose(self.decoder.token_embedding.weight, 0, 1)
+        return (logits, *attention)
+
+
+class CompiledDecoderStep:
+    """
+    The StaticDecoderStep of a model traced with TorchScript, which runs the layers without the Python
+    dispatch of the eager modules. It is traced once at startup, or loaded from `cache_path` when the
+    trace was saved there by an earlier start. The cache is only valid for the same model, device, dtype
+    and fused_attention. The trace is specialized to cross-attention keys/values of n_audio_ctx frames,
+    the steps over the shorter audio_features of truncate_encoder run on the eager modules.
+    """
+    def __init__(self, decoder: TextDecoder, align_layers: List[int], n_audio_ctx: int, cache_path: str = ""):
+        self.cache_ids = [block.attn.key.cache_id for block in decoder.blocks] + \
+            [block.attn.value.cache_id for block in decoder.blocks]
+        self.cross_ids = [block.cross_attn.key.cache_id for block in decoder.blocks] + \
+            [block.cross_attn.value.cache_id for block in decoder.blocks]
+        self.n_audio_ctx = n_audio_ctx
+        weight = decoder.token_embedding.weight
+        if cache_path and os.path.isfile(cache_path):
+            logger.info(f"loading the compiled decoder step from {cache_path}")
+            self.module = torch.jit.load(cache_path, map_location=weight.device)
+            return
+
+        n_ctx, n_state = decoder.positional_embedding.shape
+        # the cross-attention keys/values of the model, which may be int8 quantized, have the dtype of its outputs
+        dtype = decoder.blocks[0].cross_attn_ln.weight.dtype
+        tokens = torch.zeros(1, 1, dtype=torch.long, device=weight.device)
+        offset = torch.zeros(1, dtype=torch.long, device=weight.device)
+        caches = [torch.zeros(1, n_ctx, n_state, dtype=dtype, device=weight.device) for _ in self.cache_ids] + \
+            [torch.zeros(1, n_audio_ctx, n_state, dtype=dtype, device=weight.device) for _ in self.cross_ids]
+        logger.info("tracing the decoder step")
+        with torch.no_grad():
+            module = torch.jit.trace(StaticDecoderStep(decoder, align_layers).eval(), (tokens, offset, *caches), check_trace=False)
+            self.module = torch.jit.freeze(module)
+        if cache_path:
+            logger.info(f"saving the compiled decoder step to {cache_path}")
+            torch.jit.save(self.module, cache_path)
+
+    def usable(self, tokens: torch.Tensor, kv_cache):
+        """A single token of one stream whose prefill has filled the cache with the traced audio length"""
+        return isinstance(kv_cache, KVCache) and tokens.shape == (1, 1) and self.cross_ids[0] in kv_cache \
+            and kv_cache[self.cross_ids[0]].shape[1] == self.n_audio_ctx \
+            and all(cache_id in kv_cache.buffers for cache_id in self.cache_ids)
+
+    def __call__(self, tokens: torch.Tensor, kv_cache: KVCache):
+        offset = torch.tensor([kv_cache.offset], device=tokens.device)
+        caches = [kv_cache.buffers[cache_id] for cache_id in self.cache_ids] + [kv_cache[cache_id] for cache_id in self.cross_ids]
+        logits, *attention = self.module(tokens, offset, *caches)
+        kv_cache.advance(1)
+        return logits, attention
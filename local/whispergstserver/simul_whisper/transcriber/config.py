@@ -11,4 +11,23 @@ class AlignAttConfig:
     rewind_threshold: int = 200
     buffer_len: float = 30.0
     min_seg_len: float = 1.0
-    if_ckpt_path: str = ""
\ No newline at end of file
+    if_ckpt_path: str = ""
+    truncate_encoder: bool = field(default=False, metadata = {"help": "encode only the buffered content instead of a 30s padded window"})
+    encoder_margin: float = field(default=1.0, metadata = {"help": "silence kept after the content when truncate_encoder is set, in second"})
+    incremental_mel: bool = field(default=False, metadata = {"help": "keep the log-mel frames of buffered segments and only transform new samples"})
+    reuse_prefix_kv: bool = field(default=False, metadata = {"help": "keep the self-attention keys/values of committed tokens across chunks"})
+    incremental_cif: bool = field(default=False, metadata = {"help": "reuse the CIF alphas of frames seen in earlier chunks and only compute the new ones"})
+    batch_encoder: bool = field(default=False, metadata = {"help": "micro-batch the encoder calls of concurrent sessions"})
+    encoder_batch_size: int = field(default=8, metadata = {"help": "maximum number of mels encoded together when batch_encoder is set"})
+    encoder_batch_wait: float = field(default=0.02, metadata = {"help": "how long the first mel of a batch waits for others, in second"})
+    batch_decoder: bool = field(default=False, metadata = {"help": "run the single-token decoder steps of concurrent sessions as one batch"})
+    decoder_batch_size: int = field(default=8, metadata = {"help": "maximum number of sessions decoded together when batch_decoder is set"})
+    decoder_batch_wait: float = field(default=0.002, metadata = {"help": "how long the first step of a batch waits for others, in second"})
+    quantize_int8: bool = field(default=False, metadata = {"help": "dynamic int8 quantization of the Linear layers of the encoder and decoder, CPU only"})
+    quantized_model_path: str = field(default="", metadata = {"help": "where the quantized model is cached, saved on the first load and loaded instead of model_path afterwards"})
+    compute_dtype: str = field(default="float32", metadata = {"help": "float32 or bfloat16, the dtype of the encoder and decoder weights and activations"})
+    backend: str = field(default="torch", metadata = {"help": "torch or onnxruntime, which runs the graphs exported by local/export_onnx.py on CPU"})
+    onnx_dir: str = field(default="", metadata = {"help": "directory of the exported graphs when backend is onnxruntime"})
+    compile_decoder_step: bool = field(default=False, metadata = {"help": "run the single-token decoder steps through a TorchScript trace with fixed shapes, torch backend only; the chunks shortened by truncate_encoder decode eagerly"})
+    compiled_decoder_path: str = field(default="", metadata = {"help": "where the traced decoder step is cached, saved on the first load and loaded afterwards; delete it when the model changes"})
+    fused_attention: bool = field(default=False, metadata = {"help": "run the attention layers without alignment heads with scaled_dot_product_attention (torch >= 2.0), torch backend only"})
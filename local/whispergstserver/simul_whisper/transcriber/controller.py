@@ -0,0 +1,48 @@
+from typing import Optional
+
+
+class SegmentLengthController:
+    """
+    Chooses how many seconds of audio are decoded per chunk from the measured real-time factor
+    (compute time / audio duration of a chunk).
+
+    The chunk grows by `step` seconds when the smoothed RTF goes above `target_rtf`, and shrinks back
+    towards `min_length` once it drops below `target_rtf * low_ratio`. After a change the controller
+    waits for `patience` chunks of the new length before changing it again.
+    """
+    def __init__(self, min_length: float, max_length: float, target_rtf: float = 0.8,
+                 low_ratio: float = 0.5, step: Optional[float] = None, smoothing: float = 0.3, patience: int = 3):
+        self.min_length = min_length
+        self.max_length = max(min_length, max_length)
+        self.target_rtf = target_rtf
+        self.low_ratio = low_ratio
+        self.step = step if step is not None else min_length
+        self.smoothing = smoothing
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self.segment_length = self.min_length
+        self.rtf = None
+        self.since_change = 0
+
+    def update(self, compute_time: float, audio_duration: float):
+        """Record a decoded chunk, returns True when segment_length has changed"""
+        if audio_duration <= 0:
+            return False
+        rtf = compute_time / audio_duration
+        self.rtf = rtf if self.rtf is None else self.smoothing * rtf + (1 - self.smoothing) * self.rtf
+        self.since_change += 1
+        if self.since_change < self.patience:
+            return False
+
+        segment_length = self.segment_length
+        if self.rtf > self.target_rtf:
+            segment_length = min(self.max_length, segment_length + self.step)
+        elif self.rtf < self.target_rtf * self.low_ratio:
+            segment_length = max(self.min_length, segment_length - self.step)
+        if segment_length == self.segment_length:
+            return False
+        self.segment_length = segment_length
+        self.since_change = 0
+        return True
@@ -0,0 +1,78 @@
+import torch
+import torch.nn.functional as F
+
+from ..whisper.audio import mel_filters, N_FFT, N_MELS, HOP_LENGTH
+
+# log10 of the clamped power of an all-zero frame, i.e. what log_mel_spectrogram produces for padding
+SILENCE_LOG_SPEC = -10.0
+
+
+class StreamingLogMel:
+    """
+    Log-mel frontend that keeps the frames of every buffered segment and only transforms new samples.
+
+    Consecutive segments overlap by N_FFT - HOP_LENGTH samples (see SegmentWrapper and DecoderPipeline),
+    so the samples after the last complete frame are kept as a tail and the overlapping head of the next
+    segment is dropped. Frames are stored before the utterance-level normalization of log_mel_spectrogram,
+    which depends on the maximum over the whole buffer and is applied when the features are requested.
+    """
+    def __init__(self, n_mels: int = N_MELS, device=None):
+        self.n_mels = n_mels
+        self.device = device
+        self.window = torch.hann_window(N_FFT).to(device)
+        self.filters = mel_filters(device, n_mels)
+        self.reset()
+
+    def reset(self):
+        self.frames = [] # per-segment (n_mels, n_frames) log10 power, not normalized
+        self.tail = None
+
+    @property
+    def num_frames(self):
+        return sum(f.shape[1] for f in self.frames)
+
+    def push(self, segment: torch.Tensor):
+        segment = segment.to(self.device, torch.float32)
+        if self.tail is None:
+            # the reflect padding of torch.stft(center=True), only needed at the start of the stream
+            mode = "reflect" if segment.shape[0] > N_FFT // 2 else "constant"
+            samples = F.pad(segment[None, None, :], (N_FFT // 2, 0), mode=mode)[0, 0]
+        else:
+            samples = torch.cat([self.tail, segment[N_FFT - HOP_LENGTH:]])
+
+        n_frames = (samples.shape[0] - N_FFT) // HOP_LENGTH + 1 if samples.shape[0] >= N_FFT else 0
+        if n_frames > 0:
+            stft = torch.stft(
+                samples[:(n_frames - 1) * HOP_LENGTH + N_FFT], N_FFT, HOP_LENGTH,
+                window=self.window, center=False, return_complex=True
+            )
+            mel_spec = self.filters @ (stft.abs() ** 2)
+            log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        else:
+            log_spec = samples.new_zeros(self.n_mels, 0)
+        self.frames.append(log_spec)
+        self.tail = samples[n_frames * HOP_LENGTH:]
+        return n_frames
+
+    def pop_front(self):
+        self.frames = self.frames[1:]
+
+    def keep_last(self, n_segments: int):
+        self.frames = self.frames[-n_segments:] if n_segments > 0 else []
+
+    def mel(self, n_frames: int):
+        """
+        Normalized log-mel of the buffered segments, padded with silence or trimmed to `n_frames`.
+        Returns a Tensor of shape (n_mels, n_frames), like log_mel_spectrogram followed by pad_or_trim.
+        """
+        if len(self.frames) > 0:
+            log_spec = torch.cat(self.frames, dim=1)
+        else:
+            log_spec = self.window.new_zeros(self.n_mels, 0)
+        log_spec_max = log_spec.max() if log_spec.numel() > 0 else log_spec.new_tensor(SILENCE_LOG_SPEC)
+        if log_spec.shape[1] < n_frames:
+            log_spec = F.pad(log_spec, (0, n_frames - log_spec.shape[1]), value=SILENCE_LOG_SPEC)
+        log_spec = log_spec[:, :n_frames]
+        log_spec = torch.maximum(log_spec, log_spec_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec
@@ -0,0 +1,92 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import torch
+
+
+class ChunkTimer:
+    """
+    Seconds spent in each stage of decoding one chunk, plus the number of calls of the stages that
+    run more than once (the decoder steps). With `sync`, CUDA is synchronized at the end of every
+    stage so that the asynchronous kernels are counted in the stage that launched them.
+    """
+    def __init__(self, sync: bool = False):
+        self.sync = sync
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.tokens = 0
+
+    def add(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        """Milliseconds per stage, the number of decoder steps and of committed tokens"""
+        record = {name: round(seconds * 1000, 3) for name, seconds in self.seconds.items()}
+        record["decoder_steps"] = self.calls.get("decoder_step", 0)
+        record["tokens"] = self.tokens
+        return record
+
+
+class TimingHistogram:
+    """
+    Aggregates the per-chunk records of ChunkTimer.as_dict over many requests into a histogram per
+    stage with log-spaced millisecond buckets.
+    """
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    COUNTS = ("decoder_steps", "tokens")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, List[int]] = {}
+        self.totals: Dict[str, float] = {}
+        self.num_chunks = 0
+
+    def add(self, chunks: List[Dict[str, float]]):
+        with self.lock:
+            for chunk in chunks:
+                self.num_chunks += 1
+                for name, value in chunk.items():
+                    self.totals[name] = self.totals.get(name, 0.0) + value
+                    if name in self.COUNTS:
+                        continue
+                    histogram = self.histograms.setdefault(name, [0] * (len(self.BUCKETS) + 1))
+                    histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+
+    def percentile(self, name: str, q: float):
+        """Upper bound of the bucket holding the q-th quantile of a stage, in ms (inf past the last bucket)"""
+        histogram = self.histograms[name]
+        target = q * sum(histogram)
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+        return float("inf")
+
+    def report(self):
+        with self.lock:
+            if self.num_chunks == 0:
+                return "no chunks timed"
+            lines = ["{} chunks, {:.1f} decoder steps and {:.1f} tokens per chunk".format(
+                self.num_chunks,
+                self.totals.get("decoder_steps", 0) / self.num_chunks,
+                self.totals.get("tokens", 0) / self.num_chunks)]
+            for name in self.histograms:
+                lines.append("{}: mean {:.1f} ms, p50 <= {} ms, p95 <= {} ms, buckets {}".format(
+                    name, self.totals[name] / sum(self.histograms[name]),
+                    self.percentile(name, 0.5), self.percentile(name, 0.95), self.histograms[name]))
+            return "\n".join(lines)
@@ -0,0 +1,48 @@
+import os
+import logging
+
+import torch
+
+from ..whisper import load_model
+from ..whisper.model import Whisper, ModelDimensions, MultiHeadAttention
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_linear_layers(model: Whisper) -> Whisper:
+    """
+    Dynamic int8 quantization of the Linear layers of the encoder and decoder, in place. The weights are
+    stored as int8 and the activations are quantized per batch, so this only runs on CPU. The embeddings,
+    convolutions and layer norms stay in float32, as do the attention weights used for the alignment.
+    """
+    torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # the quantized modules replace the key/value Linear layers, which carried their KV cache ids
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttention):
+            module.key.cache_id = f"{module.cache_id}_key"
+            module.value.cache_id = f"{module.cache_id}_value"
+    return model
+
+
+def load_quantized_model(name: str, download_root: str, cache_path: str = "") -> Whisper:
+    """
+    Loads the model on CPU with its Linear layers quantized. With cache_path, the quantized weights are
+    saved there on the first load and later loaded from there without reading the float checkpoint.
+    """
+    if cache_path and os.path.isfile(cache_path):
+        logger.info(f"loading the quantized model from {cache_path}")
+        checkpoint = torch.load(cache_path, map_location="cpu")
+        model = quantize_linear_layers(Whisper(ModelDimensions(**checkpoint["dims"])))
+        model.load_state_dict(checkpoint["model_state_dict"])
+        model.register_buffer("alignment_heads", checkpoint["alignment_heads"].to_sparse(), persistent=False)
+        return model
+
+    model = quantize_linear_layers(load_model(name=name, device="cpu", download_root=download_root))
+    if cache_path:
+        logger.info(f"saving the quantized model to {cache_path}")
+        torch.save({
+            "dims": model.dims.__dict__,
+            "model_state_dict": model.state_dict(),
+            "alignment_heads": model.alignment_heads.to_dense(),
+        }, cache_path)
+    return model
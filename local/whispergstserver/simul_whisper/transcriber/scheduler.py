@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, List, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Collects the requests submitted by concurrent sessions and runs them together on a worker thread.
+
+    The first pending request opens a window of `max_wait` seconds, the requests submitted within it
+    (up to `max_batch_size`) are passed to `run_batch` at once and every session gets its result
+    through the Future returned by `submit`. The batch sizes and queue waits are counted for tuning.
+    """
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.02, name: str = "batch-scheduler"):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.num_waits = 0
+        self.total_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, *args) -> Future:
+        future = Future()
+        self.requests.put((time.time(), args, future))
+        return future
+
+    def run_batch(self, requests: List[Tuple]) -> List:
+        """Returns one result per request, in order. Implemented by the subclasses."""
+        raise NotImplementedError
+
+    def collect(self):
+        batch = [self.requests.get()]
+        deadline = batch[0][0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            start = time.time()
+            with self.stats_lock:
+                self.batch_sizes[len(batch)] += 1
+                for submitted, _, _ in batch:
+                    wait = start - submitted
+                    self.num_waits += 1
+                    self.total_wait += wait
+                    self.max_queue_wait = max(self.max_queue_wait, wait)
+            try:
+                with torch.no_grad():
+                    results = self.run_batch([args for _, args, _ in batch])
+            except Exception as e:
+                logger.exception("batch of {} failed".format(len(batch)))
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_wait": self.total_wait / self.num_waits if self.num_waits > 0 else 0.0,
+                "max_wait": self.max_queue_wait,
+            }
+
+    def report(self):
+        stats = self.stats()
+        return "batch sizes {}, queue wait mean {:.1f} ms, max {:.1f} ms".format(
+            stats["batch_sizes"], stats["mean_wait"] * 1000, stats["max_wait"] * 1000)
+
+
+class EncoderScheduler(BatchScheduler):
+    """
+    Micro-batches the encoder calls (InferenceBackend.encode) of concurrent sessions. Only mels with
+    the same number of frames are stacked, since the encoder attends over every frame (see truncate_encoder).
+    """
+    def __init__(self, encoder: Callable[[torch.Tensor], torch.Tensor], max_batch_size: int = 8, max_wait: float = 0.02):
+        self.encoder = encoder
+        super().__init__(max_batch_size, max_wait, name="encoder-scheduler")
+
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        """mel: (1, n_mels, n_frames), blocks until the batch containing it has been encoded"""
+        return self.submit(mel).result()
+
+    def run_batch(self, requests):
+        results = [None] * len(requests)
+        groups = {}
+        for i, (mel,) in enumerate(requests):
+            groups.setdefault(mel.shape, []).append(i)
+        for indices in groups.values():
+            mels = torch.cat([requests[i][0] for i in indices], dim=0)
+            features = self.encoder(mels)
+            for row, i in enumerate(indices):
+                results[i] = features[row:row + 1]
+        return results
+
+
+class DecoderStepScheduler(BatchScheduler):
+    """
+    Runs the single-token decoder steps of concurrent sessions as one batch. Every session keeps its
+    own greedy loop and stop conditions and only waits here for the logits of its next token.
+
+    step_fn(sessions, tokens, audio_features) decodes the batch: tokens is (batch, 1) and the other two
+    are lists with one entry per row; it returns the logits (batch, 1, n_vocab).
+    """
+    def __init__(self, step_fn: Callable, max_batch_size: int = 8, max_wait: float = 0.002):
+        self.step_fn = step_fn
+        super().__init__(max_batch_size, max_wait, name="decoder-step-scheduler")
+
+    def step(self, session, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
+        """tokens: (1, 1), the latest token of the session; returns its logits (1, 1, n_vocab)"""
+        return self.submit(session, tokens, audio_features).result()
+
+    def run_batch(self, requests):
+        sessions = [session for session, _, _ in requests]
+        tokens = torch.cat([tokens for _, tokens, _ in requests], dim=0)
+        audio_features = [features for _, _, features in requests]
+        logits = self.step_fn(sessions, tokens, audio_features)
+        return [logits[i : i + 1] for i in range(len(requests))]
@@ -1,29 +1,81 @@
-import os
 import logging
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 
 import torch
-import torch.nn.functional as F
 
-from ..whisper import load_model, DecodingOptions, tokenizer
+from ..whisper import DecodingOptions, tokenizer
+from .backend import load_backend
 from .config import AlignAttConfig
-from ..whisper.audio import log_mel_spectrogram, TOKENS_PER_SECOND, pad_or_trim, N_SAMPLES, N_FRAMES
-from ..whisper.timing import median_filter
+from .frontend import StreamingLogMel
+from .alignment import AlignmentTracker
+from .scheduler import EncoderScheduler, DecoderStepScheduler
+from .profiler import ChunkTimer
+from ..whisper.audio import log_mel_spectrogram, TOKENS_PER_SECOND, FRAMES_PER_SECOND, HOP_LENGTH, N_FFT, SAMPLE_RATE, pad_or_trim, N_FRAMES
 from ..whisper.decoding import SuppressBlank, GreedyDecoder, SuppressTokens
-import os
+from ..whisper.model import KVCache
 
 DEC_PAD = 50257
 logger = logging.getLogger(__name__)
 
+
+def _untimed(name):
+    return nullcontext()
+
+
+@dataclass
+class TokenEvent:
+    token: int
+    frame: Optional[int] = field(default=None, metadata = {"help": "most attended encoder frame, None for re-tokenized text"})
+    committed: bool = field(default=False, metadata = {"help": "False while the token is still tentative in the current chunk"})
+
+
+class StreamSession:
+    """
+    The streaming state of one audio stream. Sessions are created by PaddedAlignAttWhisper.new_session
+    and passed to infer, so one loaded model can serve several streams.
+    """
+    def __init__(self, initial_tokens: torch.Tensor, rewind_threshold: int, mel_frontend: StreamingLogMel,
+                 kv_cache: KVCache, align_tracker: AlignmentTracker, sot_kv_cache: KVCache):
+        self.initial_tokens = initial_tokens
+        self.rewind_threshold = rewind_threshold
+        self.mel_frontend = mel_frontend
+        self.kv_cache = kv_cache
+        self.align_tracker = align_tracker
+        self.sot_kv_cache = sot_kv_cache # for the no-speech probability when the start of transcript is cached
+        self.drop_count = 0
+        self.keep_count = 0
+        self.segments = []
+        self.reset(complete=True)
+
+    def reset(self, complete=False):
+        """Start a new utterance, keeping the last two segments as context unless `complete` is set"""
+        self.kv_cache.reset()
+        self.align_tracker.reset()
+        self.tokens = [self.initial_tokens]
+        if not complete and len(self.segments) > 2:
+            self.segments = self.segments[-2:]
+            self.mel_frontend.keep_last(2)
+        else:
+            self.segments = []
+            self.mel_frontend.reset()
+        self.new_segment = True
+        self.last_attend_frame = -self.rewind_threshold
+        self.cif_alphas = None # CIF weights of the content frames of the previous chunk, see incremental_cif
+
+
 class PaddedAlignAttWhisper:
-    def __init__(self, cfg: AlignAttConfig, stream_handler) -> None:
+    def __init__(self, cfg: AlignAttConfig) -> None:
             
-        model_name = os.path.basename(cfg.model_path).replace(".pt", "")
-        model_path = os.path.dirname(cfg.model_path)
-        self.model = load_model(name=model_name, download_root=model_path)
+        # the model runs behind an InferenceBackend, PyTorch by default or the exported ONNX graphs
+        self.backend = load_backend(cfg)
+        self.dims = self.backend.dims
+        self.device = self.backend.device
         checkpoint = torch.load(cfg.if_ckpt_path)
-        self.CIFLinear = torch.nn.Linear(self.model.dims.n_audio_state, 1)
+        self.CIFLinear = torch.nn.Linear(self.dims.n_audio_state, 1)
         self.CIFLinear.load_state_dict(checkpoint)
-        self.CIFLinear.to(self.model.device)
+        self.CIFLinear.to(self.device)
 
         decode_options = DecodingOptions(
             language = cfg.language, 
@@ -35,37 +87,13 @@ class PaddedAlignAttWhisper:
             language=cfg.language, 
             task=decode_options.task
         )
-        self.max_text_len = self.model.dims.n_text_ctx
-        self.num_decoder_layers = len(self.model.decoder.blocks)
+        self.max_text_len = self.dims.n_text_ctx
+        self.num_decoder_layers = self.dims.n_text_layer
         self.cfg = cfg
-        logger.addHandler(stream_handler)
-        # install hooks
-        self.dec_attns = []
-        def layer_hook(module, net_input, net_output):
-            # net_output[1]: B*num_head*token_len*audio_len
-            t = F.softmax(net_output[1], dim=-1)
-            self.dec_attns.append(t.squeeze(0))
-        for b in self.model.decoder.blocks:
-            b.cross_attn.register_forward_hook(layer_hook)
-        
-        self.kv_cache = {}
-        def kv_hook(module: torch.nn.Linear, _, net_output: torch.Tensor):
-            if module.cache_id not in self.kv_cache or net_output.shape[1] > self.max_text_len:
-                # save as-is, for the first token or cross attention
-                self.kv_cache[module.cache_id] = net_output
-            else:
-                self.kv_cache[module.cache_id] = torch.cat([self.kv_cache[module.cache_id], net_output], dim=1).detach()
-            return self.kv_cache[module.cache_id] 
-
-        for b in self.model.decoder.blocks:
-            b.attn.key.register_forward_hook(kv_hook)
-            b.attn.value.register_forward_hook(kv_hook)
-            b.cross_attn.key.register_forward_hook(kv_hook)
-            b.cross_attn.value.register_forward_hook(kv_hook)
 
         self.align_source = {}
         self.num_align_heads = 0
-        for layer_rank, head_id in self.model.alignment_heads.indices().T:
+        for layer_rank, head_id in self.backend.alignment_heads.indices().T:
             layer_rank = layer_rank.item()
             heads = self.align_source.get(layer_rank, [])
             heads.append((self.num_align_heads, head_id.item()))
@@ -75,9 +103,8 @@ class PaddedAlignAttWhisper:
         self.initial_tokens = torch.tensor(
             self.tokenizer.sot_sequence, 
             dtype=torch.long, 
-            device=self.model.device).unsqueeze(0)
+            device=self.device).unsqueeze(0)
         self.initial_token_length = self.initial_tokens.shape[1]
-        self.tokens = [self.initial_tokens]
         self.sot_index = self.tokenizer.sot_sequence.index(self.tokenizer.sot)
 
         suppress_tokens = [
@@ -97,31 +124,80 @@ class PaddedAlignAttWhisper:
         self.logit_filters.append(SuppressTokens(suppress_tokens))
         self.token_decoder = GreedyDecoder(0.0, self.tokenizer.eot)
 
-        self.segments = []
-        self.new_segment = True
-
-        self.last_attend_frame = -self.cfg.rewind_threshold
-        self.drop_count = 0
-        self.keep_count = 0
+        self.encoder_scheduler = None
+        if cfg.batch_encoder:
+            self.encoder_scheduler = EncoderScheduler(self.backend.encode, cfg.encoder_batch_size, cfg.encoder_batch_wait)
+        self.decoder_scheduler = None
+        if cfg.batch_decoder:
+            self.decoder_scheduler = DecoderStepScheduler(self.decode_steps, cfg.decoder_batch_size, cfg.decoder_batch_wait)
+
+
+    def new_session(self) -> StreamSession:
+        return StreamSession(
+            self.initial_tokens,
+            self.cfg.rewind_threshold,
+            # the mel buffers, key/value buffers and attention rows are allocated here, once per stream
+            StreamingLogMel(n_mels=self.dims.n_mels, device=self.device),
+            self.backend.new_kv_cache(self.max_text_len),
+            AlignmentTracker(self.align_source, self.num_align_heads, self.max_text_len),
+            self.backend.new_kv_cache(self.sot_index + 1),
+        )
 
     
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
-        if not self.new_segment:
+    def logits(self, session: StreamSession, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
+        if not session.new_segment:
             # only need to use the last token except in the first forward pass
             tokens = tokens[:, -1:]
-        logit = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+            if self.decoder_scheduler is not None:
+                return self.decoder_scheduler.step(session, tokens, audio_features)
+        else:
+            # the committed prefix may already be cached from the previous chunk
+            tokens = tokens[:, session.kv_cache.offset:]
+        logit, attention = self.backend.decode(tokens, audio_features, session.kv_cache)
+        for layer_rank, weights in attention:
+            session.align_tracker.update(layer_rank, weights)
         return logit
-    
 
-    def refresh_segment(self, complete=False):
-        if not complete and len(self.segments) > 2:
-            self.tokens = [self.initial_tokens] 
-            self.segments = self.segments[-2:]
-            self.last_attend_frame = -self.cfg.rewind_threshold
-        else:
-            self.tokens = [self.initial_tokens]
-            self.segments = []
-            self.last_attend_frame = -self.cfg.rewind_threshold       
+
+    def decode_steps(self, sessions, tokens: torch.Tensor, audio_features):
+        """One batched decoder step for several sessions, each with its own kv cache. Called by the DecoderStepScheduler."""
+        logits, attentions = self.backend.decode_batch(tokens, audio_features, [session.kv_cache for session in sessions])
+        for session, attention in zip(sessions, attentions):
+            for layer_rank, weights in attention:
+                session.align_tracker.update(layer_rank, weights)
+        return logits
+
+
+    def sot_logits(self, session: StreamSession, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
+        """
+        The logits at the start of transcript token for the current audio, when it is cached from an earlier chunk.
+        The tokens up to it are decoded on a cache of their own, whose cross-attention keys/values are
+        then shared with the session's cache for the decoding of the chunk.
+        """
+        session.sot_kv_cache.reset()
+        logits, _ = self.backend.decode(tokens[:, : self.sot_index + 1], audio_features, session.sot_kv_cache)
+        self.backend.share_cross_attention(session.sot_kv_cache, session.kv_cache)
+        return logits[:, self.sot_index]
+
+
+    def keep_prefix_kv_cache(self, session: StreamSession, fed_tokens: torch.Tensor, committed_tokens: torch.Tensor):
+        """
+        Keep the self-attention keys/values of the longest prefix shared by the tokens fed to the
+        decoder and the committed tokens, so the next chunk only feeds the tokens after it.
+        The cross-attention entries depend on the audio features and are always dropped.
+        The alignment tracker keeps the attention rows of the prefix (see infer), so the attention of the
+        next chunk is still normalized over all the tokens.
+
+        Note that the keys/values of every layer but the first also depend on the audio through
+        the cross-attention of the layers below, so the kept prefix reflects the previous chunk's
+        audio. This trades some accuracy for a per-chunk decoder cost that does not grow with the
+        transcript, and is only done when `reuse_prefix_kv` is set.
+        """
+        n_cached = min(fed_tokens.shape[1], committed_tokens.shape[1] - 1) # always feed at least one token
+        mismatch = (fed_tokens[0, :n_cached] != committed_tokens[0, :n_cached]).nonzero()
+        n_keep = mismatch[0, 0].item() if mismatch.numel() > 0 else n_cached
+        session.kv_cache.trim(n_keep)
+        logger.debug(f"kept {n_keep}/{committed_tokens.shape[1]} committed tokens in the kv cache")
 
 
     # from https://github.com/dqqcasia/mosst/blob/master/fairseq/models/speech_to_text/convtransformer_wav2vec_cif.py
@@ -134,28 +210,50 @@ class PaddedAlignAttWhisper:
         _num = alphas.sum(-1)
         num = target_lengths.float()
         # scaling
-        _alphas = alphas * (num / _num)[:, None].repeat(1, alphas.size(1))
-        # rm attention value that exceeds threashold
-        count = 0
-        while len(torch.where(_alphas > threshold)[0]):
-            count += 1
-            if count > 10:
+        _alphas = alphas * (num / _num)[:, None]
+        # rm attention value that exceeds threashold: a row is spread over its non-zero frames once for every
+        # value that exceeded it at the start of a pass and still does when it is reached, at most 10 passes.
+        # the rows are handled together, one peak of every row at a time
+        mask = _alphas.ne(0).float()
+        for _ in range(10):
+            peaks = _alphas > threshold
+            n_peaks = int(peaks.sum(-1).max())
+            if n_peaks == 0:
                 break
-            print('fixing alpha')
-            xs, ys = torch.where(_alphas > threshold)
-            for x, y in zip(xs, ys):
-                if _alphas[x][y] >= threshold:
-                    mask = _alphas[x].ne(0).float()
-                    mean = 0.5 * _alphas[x].sum() / mask.sum()
-                    _alphas[x] = _alphas[x] * 0.5 + mean * mask
+            # the frames of the peaks of every row in ascending order, padded with frames that are not peaks
+            order = torch.sort(peaks.to(torch.int8), dim=-1, descending=True, stable=True).indices
+            for i in range(n_peaks):
+                frame = order[:, i : i + 1]
+                spread = peaks.gather(-1, frame) & (_alphas.gather(-1, frame) >= threshold)
+                mean = 0.5 * _alphas.sum(-1, keepdim=True) / mask.sum(-1, keepdim=True)
+                _alphas = torch.where(spread, _alphas * 0.5 + mean * mask, _alphas)
 
         return _alphas, _num   
     
     
-    def fire_at_boundary(self, chunked_encoder_feature: torch.Tensor):
+    def cif_alphas(self, session: StreamSession, chunked_encoder_feature: torch.Tensor):
+        """
+        CIF weights of the content frames. With `incremental_cif`, the weights of the frames that were
+        already there in the previous chunk are taken from it and only the frames of the newest segment
+        go through CIFLinear. The earlier frames are re-encoded with every chunk, so this is approximate.
+        """
+        content_mel_len = chunked_encoder_feature.shape[1] # B, T, D
+        if not self.cfg.incremental_cif:
+            return torch.sigmoid(self.CIFLinear(chunked_encoder_feature).squeeze(dim=2))
+        # the previous weights end where the frames of the newest segment start
+        n_old = self.content_frames(session, skip_last=True) // 2
+        if session.cif_alphas is None or n_old > session.cif_alphas.shape[1] or n_old >= content_mel_len:
+            n_old = 0
+        alphas = torch.sigmoid(self.CIFLinear(chunked_encoder_feature[:, n_old:, :]).squeeze(dim=2))
+        if n_old > 0:
+            alphas = torch.cat([session.cif_alphas[:, -n_old:], alphas], dim=1)
+        session.cif_alphas = alphas
+        return alphas
+
+
+    def fire_at_boundary(self, session: StreamSession, chunked_encoder_feature: torch.Tensor):
         content_mel_len = chunked_encoder_feature.shape[1] # B, T, D
-        alphas = self.CIFLinear(chunked_encoder_feature).squeeze(dim=2) # B, T
-        alphas = torch.sigmoid(alphas)
+        alphas = self.cif_alphas(session, chunked_encoder_feature.float()) # B, T
         decode_length = torch.round(alphas.sum(-1)).int()
         alphas, _ = self.resize(alphas, decode_length)
         alphas = alphas.squeeze(0) # (T, )
@@ -170,54 +268,165 @@ class PaddedAlignAttWhisper:
             return important_positions[0] >= content_mel_len-2
 
 
-    def infer(self, segment, is_last=False):
-        self.new_segment = True
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        if self.encoder_scheduler is not None:
+            return self.encoder_scheduler.encode(mel)
+        return self.backend.encode(mel)
+
+
+    def segment_duration(self, segment: torch.Tensor):
+        """
+        Seconds of new audio in a chunk, which overlaps the previous one by N_FFT - HOP_LENGTH samples.
+        Shorter chunks (the last one of a stream) count as one segment_length.
+        """
+        return max(self.cfg.segment_length, (segment.shape[0] - (N_FFT - HOP_LENGTH)) / SAMPLE_RATE)
+
+
+    def buffered_duration(self, session: StreamSession):
+        return sum(self.segment_duration(segment) for segment in session.segments)
+
+
+    def content_frames(self, session: StreamSession, skip_last=False):
+        """Number of mel frames of the buffered segments, or of all but the newest one"""
+        if self.cfg.incremental_mel:
+            return session.mel_frontend.num_frames - (session.mel_frontend.frames[-1].shape[1] if skip_last else 0)
+        segments = session.segments[:-1] if skip_last else session.segments
+        return sum(segment.shape[0] for segment in segments) // HOP_LENGTH
+
+
+    def encoder_input(self, session: StreamSession):
+        """
+        Log-mel of the buffered segments for the encoder: a 30s padded window by default, or the
+        content plus `encoder_margin` seconds of silence when `truncate_encoder` is set. The encoder
+        slices its positional embedding to the number of input frames, so the shorter mel can be
+        encoded as-is. With `incremental_mel`, the frames come from the per-segment cache.
+        Returns the mel (1, n_mels, n_frames) and the content length in encoder frames.
+        """
+        content_frames = self.content_frames(session)
+        if not self.cfg.incremental_mel:
+            input_segments = torch.cat(session.segments, dim=0) if len(session.segments) > 1 else session.segments[0]
+
+        if self.cfg.truncate_encoder:
+            n_frames = min(N_FRAMES, content_frames + int(self.cfg.encoder_margin * FRAMES_PER_SECOND))
+            n_frames += n_frames % 2 # the second conv layer has stride 2
+        else:
+            n_frames = N_FRAMES
+
+        if self.cfg.incremental_mel:
+            mel = session.mel_frontend.mel(n_frames).unsqueeze(0)
+        else:
+            mel_padded = log_mel_spectrogram(input_segments, padding=n_frames * HOP_LENGTH, device=self.device).unsqueeze(0)
+            mel = pad_or_trim(mel_padded, n_frames)
+        logger.debug(f"encoder input: {mel.shape}, content frames: {content_frames}")
+        return mel, content_frames // 2
+
+
+    def buffer_segment(self, session: StreamSession, segment):
+        """
+        Appends a chunk to the buffered segments and evicts the oldest ones (with their tokens) past buffer_len.
+        Returns False while less than min_seg_len has been buffered, in which case nothing is evicted.
+        """
+        session.segments.append(segment)
+        if self.cfg.incremental_mel:
+            session.mel_frontend.push(segment)
+        if self.buffered_duration(session) < self.cfg.min_seg_len:
+            return False
+        # chunks may be longer than segment_length when the caller coalesces them, so evict by duration
+        while len(session.segments) > 1 and self.buffered_duration(session) >= self.cfg.buffer_len:
+            evicted_duration = self.segment_duration(session.segments[0])
+            session.segments = session.segments[1:]
+            session.mel_frontend.pop_front()
+            session.tokens = [self.initial_tokens] + session.tokens[2:]
+            session.kv_cache.reset() # the positions of the committed tokens have changed
+            session.last_attend_frame -= int(TOKENS_PER_SECOND*evicted_duration)
+            logger.debug(f"remove segments: {len(session.segments)} {len(session.tokens)}")
+        return True
+
+
+    def skip_silence(self, session: StreamSession, segment):
+        """
+        Buffers a chunk that the caller classified as silence without running the encoder and decoder.
+        The chunk is kept as digital silence, so the encoder sees zeros there when the next chunks are
+        decoded, and an empty token group keeps the tokens aligned with the segments for eviction.
+        Returns the (empty) committed tokens, like infer.
+        """
         with torch.no_grad():
-            self.segments.append(segment)
-            if len(self.segments) * self.cfg.segment_length < self.cfg.min_seg_len: 
+            silence = torch.zeros_like(segment)
+            if len(session.segments) > 0:
+                # the overlap with the previous chunk is real audio
+                overlap = min(segment.shape[0], N_FFT - HOP_LENGTH)
+                silence[:overlap] = segment[:overlap]
+            if not self.buffer_segment(session, silence):
+                return self.initial_tokens.new_tensor([]), False
+            new_tokens = self.initial_tokens.new_tensor([]).unsqueeze(0)
+            session.tokens.append(new_tokens)
+            # the CIF weights of the silent frames are not computed, the next chunk recomputes them all
+            session.cif_alphas = None
+            if not self.cfg.reuse_prefix_kv:
+                session.kv_cache.reset()
+            return new_tokens.squeeze(0)
+
+
+    def infer(self, session: StreamSession, segment, is_last=False, on_token: Optional[Callable[[TokenEvent], None]] = None,
+              timer: Optional[ChunkTimer] = None):
+        """
+        session: the state of the stream, from new_session
+        segment: the audio of the next chunk, overlapping the previous one by N_FFT - HOP_LENGTH samples
+        on_token: called with a TokenEvent for every tentative token while decoding, and for every
+            committed token once the chunk is done
+        timer: (optional) records the time spent in each stage of the chunk
+        Returns the committed tokens of this chunk.
+        """
+        stage = timer.stage if timer is not None else _untimed
+        session.new_segment = True
+        with torch.no_grad():
+            with stage("mel"):
+                buffered = self.buffer_segment(session, segment)
+            if not buffered:
                 logger.debug("waiting for next segment")
                 return self.initial_tokens.new_tensor([]), False
-            if len(self.segments) * self.cfg.segment_length >= self.cfg.buffer_len:
-                self.segments = self.segments[1:]
-                self.tokens = [self.initial_tokens] + self.tokens[2:]
-                self.last_attend_frame -= int(TOKENS_PER_SECOND*self.cfg.segment_length)
-                logger.debug(f"remove segments: {len(self.segments)} {len(self.tokens)}")
-            if len(self.segments) > 1:
-                input_segments = torch.cat(self.segments, dim=0)
-            else:
-                input_segments = self.segments[0]
-            if len(self.tokens) > 1:
-                current_tokens = torch.cat(self.tokens, dim=1)
+            if len(session.tokens) > 1:
+                current_tokens = torch.cat(session.tokens, dim=1)
             else:
-                current_tokens = self.tokens[0]
+                current_tokens = session.tokens[0]
             
-            mel_padded = log_mel_spectrogram(input_segments, padding=N_SAMPLES, device=self.model.device).unsqueeze(0)
-            logger.debug(f"after padding: {mel_padded.shape}")
-            mel = pad_or_trim(mel_padded, N_FRAMES)
-            logger.debug(f"after trim {mel.shape}")
-            content_mel_len = int((mel_padded.shape[2] - mel.shape[2])/2)
-
-            encoder_feature = self.model.encoder(mel)
+            with stage("mel"):
+                mel, content_mel_len = self.encoder_input(session)
+            with stage("encoder"):
+                encoder_feature = self.encode(mel)
             sum_logprobs = torch.zeros(1, device=mel.device)
             completed = False
 
-            attn_of_alignment_heads = None
+            # the attention rows of the cached prefix are kept, there is one row per token in the cache
+            kv_prefix_len = session.kv_cache.offset
+            session.align_tracker.trim(kv_prefix_len)
             token_len_before_decoding = current_tokens.shape[1]
+            fed_tokens = current_tokens
             
             most_attened_frame = None
-            fire_detected = self.fire_at_boundary(encoder_feature[:, :content_mel_len, :])
+            tentative_frames = []
+            with stage("cif"):
+                fire_detected = self.fire_at_boundary(session, encoder_feature[:, :content_mel_len, :])
+            sot_logits = None
+            if self.tokenizer.no_speech is not None and kv_prefix_len > self.sot_index:
+                with stage("decoder_step"):
+                    sot_logits = self.sot_logits(session, current_tokens, encoder_feature)
 
             while not completed and current_tokens.shape[1] < self.max_text_len: # bos is 3 tokens
 
-                logits = self.logits(current_tokens, encoder_feature) # B, len(tokens), token dict size
+                with stage("decoder_step"):
+                    logits = self.logits(session, current_tokens, encoder_feature) # B, len(tokens), token dict size
+                fed_tokens = current_tokens
 
-                if self.new_segment and self.tokenizer.no_speech is not None:
-                    probs_at_sot = logits[:, self.sot_index, :].float().softmax(dim=-1)
+                if session.new_segment and self.tokenizer.no_speech is not None:
+                    if sot_logits is None:
+                        sot_logits = logits[:, self.sot_index - kv_prefix_len, :]
+                    probs_at_sot = sot_logits.float().softmax(dim=-1)
                     no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
                     if no_speech_probs[0] > self.cfg.nonspeech_prob:
                         break
 
-                self.new_segment = False
+                session.new_segment = False
                 logits = logits[:, -1, :] # logits for the last token
                 for logits_filter in self.logit_filters:
                     logits_filter.apply(logits, current_tokens)
@@ -226,83 +435,80 @@ class PaddedAlignAttWhisper:
                 if completed:
                     logger.debug("decode stopped")
 
-                attn_of_alignment_heads = [[] for _ in range(self.num_align_heads)]
-                for i, attn_mat in enumerate(self.dec_attns):
-                    layer_rank = int(i % len(self.model.decoder.blocks))
-                    align_heads_in_layer = self.align_source.get(layer_rank, [])
-                    if len(align_heads_in_layer) == 0:
-                        continue
-                    for align_head_rank, head_id in align_heads_in_layer:
-                        attn_of_alignment_heads[align_head_rank].append(attn_mat[head_id, :, :])
-                tmp = []
-                for mat in attn_of_alignment_heads:
-                    tmp.append(torch.cat(mat, dim=0))
-                attn_of_alignment_heads = torch.stack(tmp, dim=0)
-                std, mean = torch.std_mean(attn_of_alignment_heads, dim=-2, keepdim=True, unbiased=False)
-                attn_of_alignment_heads = (attn_of_alignment_heads - mean) / std
-                attn_of_alignment_heads = median_filter(attn_of_alignment_heads, 7) # from whisper.timing
-                attn_of_alignment_heads = attn_of_alignment_heads.mean(dim=0)
-                attn_of_alignment_heads = attn_of_alignment_heads[:, :content_mel_len]
-
-                most_attened_frame = torch.argmax(attn_of_alignment_heads[-1, :], dim=0)
+                with stage("alignment"):
+                    most_attened_frame = session.align_tracker.most_attended_frame(content_mel_len)
 
                 if completed:
                     current_tokens = current_tokens[:, :-1]
                     break
                 
                 # for some rare cases where the attention fails
-                if not is_last and self.last_attend_frame - most_attened_frame > self.cfg.rewind_threshold:
+                if not is_last and session.last_attend_frame - most_attened_frame > self.cfg.rewind_threshold:
                     if current_tokens.shape[1] > 1 and current_tokens[0, -2] >= DEC_PAD:
                         logger.debug("ommit rewinding from special tokens")
-                        self.last_attend_frame = most_attened_frame
+                        session.last_attend_frame = most_attened_frame
                     else:
-                        logger.debug(f"[rewind detected] current attention pos: {most_attened_frame.item()}, last attention pos: {self.last_attend_frame.item()}; omit this segment")
-                        self.last_attend_frame = -self.cfg.rewind_threshold
-                        current_tokens = torch.cat(self.tokens, dim=1) if len(self.tokens) > 0 else self.tokens[0]
+                        logger.debug(f"[rewind detected] current attention pos: {most_attened_frame.item()}, last attention pos: {session.last_attend_frame.item()}; omit this segment")
+                        session.last_attend_frame = -self.cfg.rewind_threshold
+                        current_tokens = torch.cat(session.tokens, dim=1) if len(session.tokens) > 0 else session.tokens[0]
                         break
                 else:
-                    self.last_attend_frame = most_attened_frame
+                    session.last_attend_frame = most_attened_frame
 
                 if content_mel_len - most_attened_frame <= (4 if is_last else self.cfg.frame_threshold):
                     logger.debug(f"attention reaches the end: {most_attened_frame.item()}/{content_mel_len}")
                     current_tokens = current_tokens[:, :-1]
                     break
             
-                logger.debug("attn: {}, current pos: {}, current token: {}({})".format(
-                    attn_of_alignment_heads.shape if attn_of_alignment_heads is not None else None,
-                    most_attened_frame, 
-                    current_tokens[:, -1].item(),
-                    self.tokenizer.decode([current_tokens[:, -1].item()])
-                ))
-
-            if attn_of_alignment_heads is not None:
+                if on_token is not None:
+                    tentative_frames.append(int(most_attened_frame))
+                    on_token(TokenEvent(token=current_tokens[0, -1].item(), frame=tentative_frames[-1]))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("attn: {}, current pos: {}, current token: {}({})".format(
+                        session.align_tracker.length,
+                        most_attened_frame, 
+                        current_tokens[:, -1].item(),
+                        self.tokenizer.decode([current_tokens[:, -1].item()])
+                    ))
+
+            if session.align_tracker.length > 0 and logger.isEnabledFor(logging.DEBUG):
                 seg_len = int(self.cfg.segment_length*TOKENS_PER_SECOND)
-                new_token_attn = attn_of_alignment_heads[token_len_before_decoding:, -seg_len:]
+                new_token_attn = session.align_tracker.normalized(token_len_before_decoding, session.align_tracker.length, content_mel_len)[:, -seg_len:]
                 if new_token_attn.shape[0] == 0:
                     logger.debug("no token generated")
                     logger.debug(f"token len {current_tokens.shape}")
                 else:
                     new_token_max_attn, _ = new_token_attn.max(dim=1)
-                    logger.debug(f"segment max attention: {new_token_max_attn.mean().item()/len(self.segments)}")
+                    logger.debug(f"segment max attention: {new_token_max_attn.mean().item()/len(session.segments)}")
 
             new_tokens = current_tokens.new_tensor([]).unsqueeze(0)
             tokens_to_split = current_tokens[:, token_len_before_decoding:]
             if fire_detected or is_last:
                 new_tokens = tokens_to_split
-                self.keep_count += 1
+                session.keep_count += 1
+            else:
+                tentative_frames = [] # the committed tokens are re-tokenized below
+                session.drop_count += 1
+                with stage("detokenize"):
+                    tokens_to_split = tokens_to_split.squeeze(0)
+                    text_to_split = self.tokenizer.decode(tokens_to_split)
+                    logger.debug("text at current step: {}".format(text_to_split.replace(" ", "<space>")))
+                    text_before_space = " ".join(text_to_split.split(" ")[:-1])
+                    logger.debug("before the last space: {}".format(text_before_space.replace(" ", "<space>")))
+                    if len(text_before_space) > 0:
+                        new_tokens = current_tokens.new(self.tokenizer.encode(text_before_space, allowed_special="all")).unsqueeze(0)
+
+            session.tokens.append(new_tokens)
+            if timer is not None:
+                timer.tokens += new_tokens.shape[1]
+            if on_token is not None:
+                for i, token in enumerate(new_tokens[0].tolist()):
+                    frame = tentative_frames[i] if i < len(tentative_frames) else None
+                    on_token(TokenEvent(token=token, frame=frame, committed=True))
+
+            if self.cfg.reuse_prefix_kv:
+                self.keep_prefix_kv_cache(session, fed_tokens, torch.cat(session.tokens, dim=1))
             else:
-                self.drop_count += 1
-                tokens_to_split = tokens_to_split.squeeze(0)
-                text_to_split = self.tokenizer.decode(tokens_to_split)
-                logger.debug("text at current step: {}".format(text_to_split.replace(" ", "<space>")))
-                text_before_space = " ".join(text_to_split.split(" ")[:-1])
-                logger.debug("before the last space: {}".format(text_before_space.replace(" ", "<space>")))
-                if len(text_before_space) > 0:
-                    new_tokens = current_tokens.new(self.tokenizer.encode(text_before_space, allowed_special="all")).unsqueeze(0)
-
-            self.tokens.append(new_tokens)
-
-            self.dec_attns = []
-            self.kv_cache = {}
+                session.kv_cache.reset()
 
             return new_tokens.squeeze(0)
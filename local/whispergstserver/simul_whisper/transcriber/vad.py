@@ -0,0 +1,51 @@
+import torch
+
+from ..whisper.audio import SAMPLE_RATE
+
+
+class EnergyVAD:
+    """
+    Energy and zero-crossing voice activity detector for the chunks of a stream.
+
+    The chunk is cut into `frame_ms` frames. A frame is speech when its energy is `margin` dB above the
+    noise floor (and above `min_energy` dBFS), or `margin / 2` dB above it with a zero-crossing rate
+    in the range of fricatives. The noise floor follows the quietest frames and rises slowly.
+    A chunk is speech when `min_speech_ratio` of its frames are, and the `hangover` chunks after
+    a speech chunk are kept too, so that the decoder still sees the end of the words.
+    """
+    def __init__(self, margin: float = 10.0, min_energy: float = -50.0, min_speech_ratio: float = 0.1,
+                 hangover: int = 1, frame_ms: int = 30, floor_rise: float = 0.05):
+        self.margin = margin
+        self.min_energy = min_energy
+        self.min_speech_ratio = min_speech_ratio
+        self.hangover = hangover
+        self.frame_size = SAMPLE_RATE * frame_ms // 1000
+        self.floor_rise = floor_rise # dB per frame
+        self.reset()
+
+    def reset(self):
+        self.noise_floor = None
+        self.speech_chunks_ago = None # chunks since the last speech chunk, None before the first one
+
+    def is_speech(self, samples: torch.Tensor) -> bool:
+        n_frames = samples.shape[0] // self.frame_size
+        if n_frames == 0:
+            return True
+        frames = samples[:n_frames * self.frame_size].float().view(n_frames, self.frame_size)
+        energy = 10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)
+        zcr = (frames[:, 1:].sign() != frames[:, :-1].sign()).float().mean(dim=1)
+
+        # the floor before this chunk, so a chunk that is loud from start to end is compared to the pause before it
+        floor = energy.min().item() if self.noise_floor is None else self.noise_floor
+        above = energy - floor
+        speech = (above > self.margin) | ((above > self.margin / 2) & (zcr > 0.1) & (zcr < 0.5))
+        speech &= energy > self.min_energy
+        self.noise_floor = min(energy.min().item(), floor + self.floor_rise * n_frames)
+
+        if speech.float().mean().item() >= self.min_speech_ratio:
+            self.speech_chunks_ago = 0
+            return True
+        if self.speech_chunks_ago is not None:
+            self.speech_chunks_ago += 1
+            return self.speech_chunks_ago <= self.hangover
+        return False
@@ -1,7 +1,7 @@
 import base64
 import gzip
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, List, Optional, Union
 
 import numpy as np
 import torch
@@ -58,6 +58,56 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 
+class KVCache:
+    """
+    Decoder key/value cache with fixed-capacity buffers.
+
+    Self-attention keys/values are written into buffers of `n_ctx` positions at `offset` and read
+    back as views of the filled part, so decoding a token does not reallocate the cache.
+    Cross-attention keys/values only depend on the audio features and are stored as-is.
+    `TextDecoder.forward` advances `offset` once all layers have written the new positions.
+    """
+    def __init__(self, n_ctx: int):
+        self.n_ctx = n_ctx
+        self.offset = 0
+        self.buffers: Dict[str, Tensor] = {}
+        self.cross: Dict[str, Tensor] = {}
+
+    def __contains__(self, cache_id: str):
+        return cache_id in self.cross
+
+    def __getitem__(self, cache_id: str):
+        return self.cross[cache_id]
+
+    def set_cross(self, cache_id: str, x: Tensor):
+        self.cross[cache_id] = x
+        return x
+
+    def update(self, cache_id: str, x: Tensor):
+        """Write the keys/values of the new positions and return a view of all cached positions"""
+        end = self.offset + x.shape[1]
+        if end > self.n_ctx:
+            raise ValueError(f"KVCache overflow: {end} > {self.n_ctx} positions")
+        buffer = self.buffers.get(cache_id)
+        if buffer is None or buffer.shape[0] != x.shape[0] or buffer.dtype != x.dtype or buffer.device != x.device:
+            # zeroed, the compiled decoder step attends over the whole buffer with the unused positions masked
+            buffer = x.new_zeros(x.shape[0], self.n_ctx, x.shape[2])
+            self.buffers[cache_id] = buffer
+        buffer[:, self.offset : end] = x
+        return buffer[:, :end]
+
+    def advance(self, n: int):
+        self.offset += n
+
+    def trim(self, n: int):
+        """Keep the first `n` positions of the self-attention cache; cross-attention entries are dropped"""
+        self.offset = min(self.offset, n)
+        self.cross = {}
+
+    def reset(self):
+        self.trim(0)
+
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_state: int, n_head: int, cache_id: str):
         super().__init__()
@@ -69,6 +119,8 @@ class MultiHeadAttention(nn.Module):
         self.value.cache_id = f"{cache_id}_value"
         self.out = nn.Linear(n_state, n_state)
         self.cache_id = cache_id
+        self.return_weights = False
+        self.fused = False
 
     def forward(
         self,
@@ -79,7 +131,20 @@ class MultiHeadAttention(nn.Module):
     ):
         q = self.query(x)
 
-        if kv_cache is None or xa is None or self.key.cache_id not in kv_cache:
+        if isinstance(kv_cache, list):
+            return self.ragged_forward(x, q, xa, kv_cache)
+
+        if isinstance(kv_cache, KVCache):
+            if xa is None:
+                k = kv_cache.update(self.key.cache_id, self.key(x))
+                v = kv_cache.update(self.value.cache_id, self.value(x))
+            elif self.key.cache_id in kv_cache:
+                k = kv_cache[self.key.cache_id]
+                v = kv_cache[self.value.cache_id]
+            else:
+                k = kv_cache.set_cross(self.key.cache_id, self.key(xa))
+                v = kv_cache.set_cross(self.value.cache_id, self.value(xa))
+        elif kv_cache is None or xa is None or self.key.cache_id not in kv_cache:
             k = self.key(x if xa is None else xa)
             v = self.value(x if xa is None else xa)
             # print(self.key.cache_id, "cache miss") # , kv_cache is None, xa is None, self.key.cache_id not in kv_cache if kv_cache is not None else None, k.shape, x.shape)
@@ -95,10 +160,49 @@ class MultiHeadAttention(nn.Module):
         wv, qk = self.qkv_attention(q, k, v, mask)
         return self.out(wv), qk
 
+    def ragged_forward(self, x: Tensor, q: Tensor, xa: Optional[List[Tensor]], kv_caches: List[KVCache]):
+        """
+        One decoding step for a batch of streams, each row with its own KVCache of its own length.
+        The projections run on the whole batch and the attention row by row, so no padding mask is needed;
+        the single query of every row is its latest position and attends to all of its cached positions.
+        Returns the output and a list with the pre-softmax attention of every row.
+        """
+        if xa is None:
+            keys, values = self.key(x), self.value(x)
+        outputs, qks = [], []
+        for i, kv_cache in enumerate(kv_caches):
+            if xa is None:
+                k = kv_cache.update(self.key.cache_id, keys[i : i + 1])
+                v = kv_cache.update(self.value.cache_id, values[i : i + 1])
+            elif self.key.cache_id in kv_cache:
+                k = kv_cache[self.key.cache_id]
+                v = kv_cache[self.value.cache_id]
+            else:
+                k = kv_cache.set_cross(self.key.cache_id, self.key(xa[i]))
+                v = kv_cache.set_cross(self.value.cache_id, self.value(xa[i]))
+            wv, qk = self.qkv_attention(q[i : i + 1], k, v)
+            outputs.append(wv)
+            qks.append(qk)
+        return self.out(torch.cat(outputs)), qks
+
     def qkv_attention(
         self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
     ):
+        """
+        Returns the attention output and, as set by `Whisper.set_attention_outputs`, the pre-softmax
+        attention (the default), the float32 softmax weights (`return_weights`) or None (`fused`).
+        """
         n_batch, n_ctx, n_state = q.shape
+        if self.fused:
+            # the default scale of the fused kernel is 1/sqrt(head dim), the same as the two factors below
+            q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            if mask is not None:
+                mask = mask[:n_ctx, :k.shape[2]].to(q.dtype)
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+            return wv.permute(0, 2, 1, 3).flatten(start_dim=2), None
+
         scale = (n_state // self.n_head) ** -0.25
         q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) * scale
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 3, 1) * scale
@@ -106,11 +210,18 @@ class MultiHeadAttention(nn.Module):
 
         qk = q @ k
         if mask is not None:
-            qk = qk + mask[:n_ctx, :n_ctx]
+            # the rows of `mask` start at the position of the first query (see TextDecoder.forward)
+            qk = qk + mask[:n_ctx, :qk.shape[-1]]
         # qk = qk.float()
 
-        w = F.softmax(qk, dim=-1) # .to(q.dtype)
-        return (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2), qk.detach()
+        if qk.dtype == torch.float32:
+            w = F.softmax(qk, dim=-1)
+            weights = w
+        else:
+            # reduced precision weights and activations, the softmax is computed in float32
+            weights = F.softmax(qk.float(), dim=-1)
+            w = weights.to(q.dtype)
+        return (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2), weights.detach() if self.return_weights else qk.detach()
 
 
 class ResidualAttentionBlock(nn.Module):
@@ -208,15 +319,34 @@ class TextDecoder(nn.Module):
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(self, x: Tensor, xa: Union[Tensor, List[Tensor]], kv_cache: Optional[Union[dict, KVCache, List[KVCache]]] = None):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        kv_cache : dict, KVCache or list of KVCache
+            a dict filled by the hooks of `Whisper.install_kv_cache_hooks`, or a KVCache.
+            With a list, every row of `x` is a single token of a different stream with its own cache
+            and `xa` is the list of their audio features (see `MultiHeadAttention.ragged_forward`)
         """
 
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+        n_tokens = x.shape[-1]
+        if isinstance(kv_cache, list):
+            assert n_tokens == 1, "ragged batches decode one token per row"
+            offsets = torch.tensor([c.offset for c in kv_cache], device=x.device)
+            x = self.token_embedding(x) + self.positional_embedding[offsets].unsqueeze(1)
+            for block in self.blocks:
+                x = block(x, xa, kv_cache=kv_cache)
+            for c in kv_cache:
+                c.advance(n_tokens)
+            x = self.ln(x)
+            return x @ torch.transpose(self.token_embedding.weight, 0, 1)
+
+        if isinstance(kv_cache, KVCache):
+            offset = kv_cache.offset
+        else:
+            offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
         x = (
             self.token_embedding(x)
             + self.positional_embedding[offset : offset + x.shape[-1]]
@@ -226,9 +356,12 @@ class TextDecoder(nn.Module):
         i = 0
         for block in self.blocks:
             # print(f"decoder layer {i}")
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
+            x = block(x, xa, mask=self.mask[offset:], kv_cache=kv_cache)
             i += 1
 
+        if isinstance(kv_cache, KVCache):
+            kv_cache.advance(n_tokens)
+
         x = self.ln(x)
         logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
 
@@ -269,6 +402,25 @@ class Whisper(nn.Module):
         )
         self.register_buffer("alignment_heads", mask.to_sparse(), persistent=False)
 
+    def set_attention_outputs(self, weight_layers: Iterable[int], fused: bool = False):
+        """
+        The cross-attention of the decoder layers in `weight_layers` returns its float32 softmax weights
+        instead of the pre-softmax attention. With `fused`, every other attention layer runs the fused
+        scaled_dot_product_attention kernel (torch >= 2.0) and returns no weights.
+        Returns whether the fused kernel is used.
+        """
+        fused = fused and hasattr(F, "scaled_dot_product_attention")
+        weight_layers = set(weight_layers)
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttention):
+                module.return_weights = False
+                module.fused = fused
+        for layer_rank, block in enumerate(self.decoder.blocks):
+            if layer_rank in weight_layers:
+                block.cross_attn.return_weights = True
+                block.cross_attn.fused = False
+        return fused
+
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    def __init__(self, deadline, callback, args, name):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerService(object):
+    """
+    Runs the deadlines of all the sessions of a worker from one thread. The timers are kept in a heap
+    ordered by deadline and their callbacks run on a small thread pool, so that a slow callback does not
+    hold back the others. Cancelled timers are dropped when they reach the top of the heap.
+    A callback that starts more than `tolerance` seconds after its deadline is logged and counted as missed.
+    """
+    def __init__(self, max_workers=4, tolerance=0.5):
+        self.tolerance = tolerance
+        self.max_workers = max_workers
+        self.heap = []
+        self.counter = itertools.count() # orders the timers with the same deadline
+        self.condition = threading.Condition()
+        self.executor = None
+        self.thread = None
+        self.num_fired = 0
+        self.num_missed = 0
+        self.max_lateness = 0.0
+
+    def schedule(self, delay, callback, *args, name="timer"):
+        """Calls callback(*args) in `delay` seconds unless the returned Timer is cancelled first"""
+        timer = Timer(time.monotonic() + delay, callback, args, name)
+        with self.condition:
+            if self.thread is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="timer")
+                self.thread = threading.Thread(target=self.loop, name="timer-service", daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    deadline, _, timer = self.heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self.heap)
+                        continue
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        heapq.heappop(self.heap)
+                        break
+                    self.condition.wait(timeout)
+            self.executor.submit(self.run, timer)
+
+    def run(self, timer):
+        if timer.cancelled:
+            return
+        lateness = time.monotonic() - timer.deadline
+        with self.condition:
+            self.num_fired += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+            if lateness > self.tolerance:
+                self.num_missed += 1
+        if lateness > self.tolerance:
+            logger.warning("Timer %s fired %.2f seconds after its deadline" % (timer.name, lateness))
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            logger.exception("Timer %s failed" % timer.name)
+
+    def stats(self):
+        with self.condition:
+            return dict(pending=len(self.heap), fired=self.num_fired, missed=self.num_missed, max_lateness=self.max_lateness)
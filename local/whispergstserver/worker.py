@@ -18,7 +18,6 @@ import _thread as thread
 import threading
 import os
 import argparse
-from subprocess import Popen, PIPE
 from gi.repository import GLib
 import yaml
 import json
@@ -28,6 +27,8 @@ import codecs
 import zlib
 import base64
 import time
+import uuid
+import urllib.parse
 
 import asyncio
 from tornado.platform.asyncio import AnyThreadEventLoopPolicy
@@ -35,11 +36,15 @@ import tornado.gen
 import tornado.process
 import tornado.ioloop
 import tornado.locks
+from tornado.concurrent import Future
 from ws4py.client.threadedclient import WebSocketClient
 import ws4py.messaging
 from ws4py.messaging import TextMessage
 
 from decoder import DecoderPipeline
+from timers import TimerService
+from postprocessor import PostProcessorPool
+from local.whispergstserver.simul_whisper.transcriber.profiler import TimingHistogram
 
 import common
 
@@ -59,6 +64,12 @@ class ServerWebsocket(WebSocketClient):
     STATE_CANCELLING = 8
     STATE_FINISHED = 100
     ID_TO_STATE = { 0: "STATE_CREATED", 1: "STATE_CONNECTED", 2: "STATE_INITIALIZED", 3: "STATE_PROCESSING", 7: "STATE_EOS_RECEIVED", 8: "STATE_CANCELLING", 100: "STATE_FINISHED" }
+    # the IOLoop serving the post-processor pipes, the results are post-processed and sent on it
+    io_loop = None
+    # the chunk timings of all the requests served by the process, when the pipelines collect them
+    timing_histogram = TimingHistogram()
+    # the silence, frontend and decoder deadlines of all the streams, see received_message and finish_request
+    timers = TimerService()
 
     def __init__(self, uri, decoder_pipeline, post_processor, full_post_processor=None):
         self.uri = uri
@@ -68,20 +79,27 @@ class ServerWebsocket(WebSocketClient):
         WebSocketClient.__init__(self, url=uri, heartbeat_freq=10)
         self.pipeline_initialized = False
         self.partial_transcript = ""
-        self.decoder_pipeline.set_result_handler(self._on_result)
-        self.decoder_pipeline.set_full_result_handler(self._on_full_result)
+        self.decoder_pipeline.set_result_handler(self._schedule_result)
+        self.decoder_pipeline.set_full_result_handler(self._schedule_full_result)
         self.decoder_pipeline.set_error_handler(self._on_error)
         self.decoder_pipeline.set_eos_handler(self._on_eos)
+        self.decoder_pipeline.set_chunk_handler(self._schedule_segment_length)
         self.state = self.STATE_CREATED
         self.last_decoder_message = time.time()
         self.request_id = "<undefined>"
         self.timeout_decoder = 5
         self.num_segments = 0
         self.last_partial_result = ""
+        # with delta_partials, partial results only carry what changed since the last one sent
+        self.delta_partials = False
+        self.last_sent_transcript = ""
         asyncio.set_event_loop_policy(AnyThreadEventLoopPolicy())
-        self.post_processor_lock = threading.Lock()
         self.processing_condition = threading.Condition()
         self.num_processing_threads = 0
+        self.frontend_timer = None
+        self.silence_timer = None
+        # resolved once the latest result has been sent, so that the results are sent in order
+        self.last_result_sent = None
         logger.debug("[DEBUG][INIT] state = {}".format(self.ID_TO_STATE[self.state]))
         
     def opened(self):
@@ -91,41 +109,48 @@ class ServerWebsocket(WebSocketClient):
         logger.debug("[DEBUG][OPEN] state = {}".format(self.ID_TO_STATE[self.state]))
         # self.decoder_pipeline = decoder_pipeline
     
-    def guard_timeout(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
+    def start_silence_timeout(self):
+        self.silence_timer = self.timers.schedule(SILENCE_TIMEOUT, self.silence_timeout, name="%s silence" % self.request_id)
+
+    def silence_timeout(self):
         global SILENCE_TIMEOUT
-        while self.state in [self.STATE_EOS_RECEIVED, self.STATE_CONNECTED, self.STATE_INITIALIZED, self.STATE_PROCESSING]:
-            logger.debug("[DEBUG][GT] state = {}, ({:.4f} > {})".format(self.ID_TO_STATE[self.state], time.time() - self.last_decoder_message, SILENCE_TIMEOUT))
-            if time.time() - self.last_decoder_message > SILENCE_TIMEOUT:
-                logger.warning("%s: More than %d seconds from last decoder hypothesis update, cancelling" % (self.request_id, SILENCE_TIMEOUT))
-                self.finish_request()
-                event = dict(status=common.STATUS_NO_SPEECH)
-                try:
-                    self.send(json.dumps(event))
-                except:
-                    logger.warning("%s: Failed to send error event to master" % (self.request_id))
-                self.close()
-                return
-            logger.debug("%s: Checking that decoder hasn't been silent for more than %d seconds" % (self.request_id, SILENCE_TIMEOUT))
-            time.sleep(1)
+        if self.state not in [self.STATE_EOS_RECEIVED, self.STATE_CONNECTED, self.STATE_INITIALIZED, self.STATE_PROCESSING]:
+            return
+        silent_time = time.time() - self.last_decoder_message
+        logger.debug("[DEBUG][GT] state = {}, ({:.4f} > {})".format(self.ID_TO_STATE[self.state], silent_time, SILENCE_TIMEOUT))
+        if silent_time <= SILENCE_TIMEOUT:
+            # there has been a hypothesis since the timer was set, wait for the rest of the timeout
+            self.silence_timer = self.timers.schedule(SILENCE_TIMEOUT - silent_time, self.silence_timeout, name="%s silence" % self.request_id)
+            return
+        logger.warning("%s: More than %d seconds from last decoder hypothesis update, cancelling" % (self.request_id, SILENCE_TIMEOUT))
+        self.cancel_on_timeout()
 
     def frontend_timeout(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
         global FRONTEND_TIMEOUT
-        while self.state in [self.STATE_CONNECTED, self.STATE_INITIALIZED, self.STATE_PROCESSING]:
-            logger.debug("[DEBUG][FT] state = {}, ({:.4f} > {})".format(self.ID_TO_STATE[self.state], time.time() - self.first_connection_time, FRONTEND_TIMEOUT))
-            if time.time() - self.first_connection_time > FRONTEND_TIMEOUT:
-                logger.warning("%s: More than %d seconds from last decoder hypothesis update, cancelling" % (self.request_id, FRONTEND_TIMEOUT))
-                self.finish_request()
-                event = dict(status=common.STATUS_NO_SPEECH)
-                try:
-                    self.send(json.dumps(event))
-                except:
-                    logger.warning("%s: Failed to send error event to master" % (self.request_id))
-                self.close()
-                return
-            logger.debug("%s: Checking that waveform from frontend hasn't been large than %d seconds" % (self.request_id, FRONTEND_TIMEOUT))
-            time.sleep(1)
+        if self.state not in [self.STATE_CONNECTED, self.STATE_INITIALIZED, self.STATE_PROCESSING]:
+            return
+        logger.warning("%s: More than %d seconds from last decoder hypothesis update, cancelling" % (self.request_id, FRONTEND_TIMEOUT))
+        self.cancel_on_timeout()
+
+    def cancel_on_timeout(self):
+        # runs on a timer thread, which must not wait for the decoder: the decoding is stopped here and the
+        # decoder is reset by finish_request on the thread of the connection, once it is closed
+        self.state = self.STATE_CANCELLING
+        self.cancel_timers()
+        self.decoder_pipeline.stop()
+        event = dict(status=common.STATUS_NO_SPEECH)
+        try:
+            self.send(json.dumps(event))
+        except:
+            logger.warning("%s: Failed to send error event to master" % (self.request_id))
+        self.close()
+
+    def cancel_timers(self):
+        for timer in [self.frontend_timer, self.silence_timer]:
+            if timer is not None:
+                timer.cancel()
+        self.frontend_timer = None
+        self.silence_timer = None
 
     def received_message(self, m):
         logger.debug("%s: Got message from server of type %s" % (self.request_id, str(type(m)))) 
@@ -145,21 +170,24 @@ class ServerWebsocket(WebSocketClient):
                 self.prons_length = [ int(i) for i in props['prons_length'].split("_") ]
             else:
                 self.prons_length = None
+            self.delta_partials = props.get("delta_partials", False)
+            self.last_sent_transcript = ""
 
             self.num_segments = 0
-            self.decoder_pipeline.init_request(self.request_id, self.user_id)
+            self.decoder_pipeline.init_request(self.request_id, self.user_id, content_type)
             self.last_decoder_message = time.time()
             self.decoder_pipeline.process_prompt(self.prompt)
             logger.info("%s: Initialized request" % self.request_id)
             self.state = self.STATE_INITIALIZED
             logger.info("%s: Starting timeout frontend" % self.request_id)
             self.first_connection_time = time.time()
-            thread.start_new_thread(self.frontend_timeout, ())
+            self.frontend_timer = self.timers.schedule(FRONTEND_TIMEOUT, self.frontend_timeout, name="%s frontend" % self.request_id)
+            self.start_silence_timeout()
         elif isinstance(m, ws4py.messaging.TextMessage) and str(m) == "EOS":
             if self.state != self.STATE_CANCELLING and self.state != self.STATE_EOS_RECEIVED and self.state != self.STATE_FINISHED:
                 logger.info("%s: Got EOS, worker is in state %s" % (self.request_id, self.ID_TO_STATE[self.state]))
-                self.decoder_pipeline.recv_and_rec_data(is_final=True)
-                self.decoder_pipeline.end_request()
+                # decodes the rest of the audio and ends the request on the decoding thread
+                self.decoder_pipeline.schedule_decoding(is_final=True)
                 # self.state = self.STATE_EOS_RECEIVED
             else:
                 logger.info("%s: Ignoring EOS, worker already in state %s" % (self.request_id, self.ID_TO_STATE[self.state]))
@@ -168,7 +196,8 @@ class ServerWebsocket(WebSocketClient):
                 if isinstance(m, ws4py.messaging.BinaryMessage):
                     logger.warning("%s: Got Binary message from master server" % (self.request_id))
                     self.decoder_pipeline.process_data(m.data)
-                    self.decoder_pipeline.recv_and_rec_data()
+                    self.decoder_pipeline.schedule_decoding()
+                    logger.debug("%s: Decoding lag %.2f s" % (self.request_id, self.decoder_pipeline.lag()))
                     self.state = self.STATE_PROCESSING
                 elif isinstance(m, ws4py.messaging.TextMessage):
                     props = json.loads(str(m))
@@ -178,6 +207,7 @@ class ServerWebsocket(WebSocketClient):
 
     def finish_request(self):
         logger.debug("[DEBUG][FINISH_REQ] state = {}".format(self.ID_TO_STATE[self.state]))
+        self.cancel_timers()
         if self.state == self.STATE_CONNECTED:
             # connection closed when we are not doing anything
             self.decoder_pipeline.finish_request()
@@ -191,21 +221,29 @@ class ServerWebsocket(WebSocketClient):
         if self.state != self.STATE_FINISHED:
             logger.info("%s: Master disconnected before decoder reached EOS?" % self.request_id)
             self.state = self.STATE_CANCELLING
-            self.decoder_pipeline.cancel()
-            counter = 0
-            while self.state == self.STATE_CANCELLING:
-                counter += 1
-                if counter > DECODER_TIMEOUT:
-                    # lost hope that the decoder will ever finish, likely it has hung
-                    # FIXME: this might introduce new bugs
-                    logger.info("%s: Giving up waiting after %d tries" % (self.request_id, counter))
-                    self.state = self.STATE_FINISHED
-                else:
-                    logger.info("%s: Waiting for EOS from decoder" % self.request_id)
-                    time.sleep(1)
+            # cancel() returns once the chunk being decoded is done, after that no EOS can come from the decoder,
+            # or once the decoder deadline has given up on it
+            decoder_deadline = threading.Event()
+            decoder_timer = self.timers.schedule(DECODER_TIMEOUT, self.decoder_timeout, decoder_deadline, name="%s decoder" % self.request_id)
+            stopped = self.decoder_pipeline.cancel(abort=decoder_deadline)
+            decoder_timer.cancel()
+            if not stopped:
+                # the connection is dropped so that main_loop reconnects, the stale decoding cannot end the next request
+                self.state = self.STATE_FINISHED
+                try:
+                    self.close()
+                except:
+                    logger.warning("%s: Failed to close the connection to master" % (self.request_id))
+                return
+            self.state = self.STATE_FINISHED
             self.decoder_pipeline.finish_request()
             logger.info("%s: Finished waiting for EOS" % self.request_id)
 
+    def decoder_timeout(self, decoder_deadline):
+        # lost hope that the decoder will ever finish, likely it has hung
+        logger.warning("%s: Decoder has not stopped after %d seconds, reconnecting" % (self.request_id, DECODER_TIMEOUT))
+        decoder_deadline.set()
+
 
     def closed(self, code, reason=None):
         logger.debug("[DEBUG][CLOSE] state = {}".format(self.ID_TO_STATE[self.state]))
@@ -222,11 +260,30 @@ class ServerWebsocket(WebSocketClient):
         self.processing_condition.release()
         logger.info("%s: [increment_num_processing] Ended"  % (self.request_id))
 
+    def _schedule_result(self, result, final):
+        # called from the decoding thread, _on_eos waits until the result has been sent
+        self._increment_num_processing(1)
+        self.io_loop.add_callback(self._on_result, result, final)
+
+    def _schedule_full_result(self, full_result_json):
+        self._increment_num_processing(1)
+        self.io_loop.add_callback(self._on_full_result, full_result_json)
+
+    def _schedule_segment_length(self, segment_length, rtf):
+        self._increment_num_processing(1)
+        self.io_loop.add_callback(self._on_segment_length, segment_length, rtf)
+
+    def _next_result(self):
+        '''The Future of the previous result being sent, and the one to resolve once this result is sent'''
+        previous = self.last_result_sent
+        self.last_result_sent = Future()
+        return previous, self.last_result_sent
+
     @tornado.gen.coroutine
     def _on_result(self, result, final):
         logger.debug("[DEBUG][ON_RSLT] state = {}, (final={}; result={})".format(self.ID_TO_STATE[self.state], final, result))
+        sent = None
         try:
-            self._increment_num_processing(1)
             if final:
                 # final results are handled by _on_full_result()
                 return
@@ -234,34 +291,58 @@ class ServerWebsocket(WebSocketClient):
             if self.last_partial_result == result:
                 return
             self.last_partial_result = result
+            previous, sent = self._next_result()
             logger.info("%s: Postprocessing (final=%s) result.."  % (self.request_id, final))
-            processed_transcripts = yield self.post_process([result], blocking=False)
+            processed_transcripts = yield self.post_process([result])
+            if previous is not None:
+                yield previous
             if processed_transcripts:
                 logger.info("%s: Postprocessing done." % self.request_id)
                 event = dict(status=common.STATUS_SUCCESS,
                              segment=self.num_segments,
-                             result=dict(hypotheses=dict(transcript=processed_transcripts[0]), final=final))
+                             result=dict(hypotheses=self._partial_hypotheses(processed_transcripts[0]), final=final))
                 try:
                     self.send(json.dumps(event))
                 except:
                     e = sys.exc_info()[1]
                     logger.warning("Failed to send event to master: %s" % e)
         finally:
+            if sent is not None:
+                sent.set_result(None)
             self._increment_num_processing(-1)
 
+    def _partial_hypotheses(self, transcript):
+        '''
+        The full transcript, or with delta_partials the number of characters shared with the previous
+        partial result (stable) and the text that replaces the rest (tail). The final result is always full.
+        '''
+        if not self.delta_partials:
+            return dict(transcript=transcript)
+        previous = self.last_sent_transcript
+        stable = 0
+        max_stable = min(len(previous), len(transcript))
+        while stable < max_stable and previous[stable] == transcript[stable]:
+            stable += 1
+        self.last_sent_transcript = transcript
+        return dict(stable=stable, tail=transcript[stable:])
+
     @tornado.gen.coroutine
     def _on_full_result(self, full_result_json):
         logger.debug("[DEBUG][ON_FULL] state = {}, (result_json={})".format(self.ID_TO_STATE[self.state], full_result_json))
+        previous, sent = self._next_result()
         try:
-            self._increment_num_processing(1)
-            
             self.last_decoder_message = time.time()
             full_result = json.loads(full_result_json)
             full_result['segment'] = self.num_segments
             full_result['id'] = self.request_id
+            if "timing" in full_result:
+                self.timing_histogram.add(full_result["timing"]["chunks"])
+                logger.info("%s: Chunk timings of all requests:\n%s" % (self.request_id, self.timing_histogram.report()))
             if full_result.get("status", -1) == common.STATUS_SUCCESS:
                 logger.debug(u"%s: Before postprocessing: %s" % (self.request_id, repr(full_result)))
                 full_result = yield self.post_process_full(full_result)
+                if previous is not None:
+                    yield previous
                 logger.info("%s: Postprocessing done." % self.request_id)
                 logger.debug(u"%s: After postprocessing: %s" % (self.request_id, repr(full_result)))
 
@@ -274,8 +355,11 @@ class ServerWebsocket(WebSocketClient):
                 if full_result.get("result", {}).get("final", True):
                     self.num_segments += 1
                     self.last_partial_result = ""
+                    self.last_sent_transcript = ""
             else:
                 logger.info("%s: Result status is %d, forwarding the result to the server anyway" % (self.request_id, full_result.get("status", -1)))
+                if previous is not None:
+                    yield previous
                 try:
                     logger.debug("[UNK][status!=0] full_request is {}".format(full_result))
                     self.send(json.dumps(full_result))
@@ -283,6 +367,7 @@ class ServerWebsocket(WebSocketClient):
                     e = sys.exc_info()[1]
                     logger.warning("Failed to send event to master: %s" % e)
         finally:
+            sent.set_result(None)
             self._increment_num_processing(-1)
             logger.debug("[DEBUG][ON_FULLf] state = {}, (result_json={})".format(self.ID_TO_STATE[self.state], full_result_json))
     
@@ -298,7 +383,7 @@ class ServerWebsocket(WebSocketClient):
                     self.partial_transcript += " "
                 self.partial_transcript += word
                 logger.debug("%s: Postprocessing partial result.."  % self.request_id)
-                processed_transcript = (yield self.post_process([self.partial_transcript], blocking=False))[0]
+                processed_transcript = (yield self.post_process([self.partial_transcript]))[0]
                 if processed_transcript:
                     logger.debug("%s: Postprocessing done." % self.request_id)
 
@@ -308,7 +393,7 @@ class ServerWebsocket(WebSocketClient):
                     self.send(json.dumps(event))
             else:
                 logger.info("%s: Postprocessing final result.."  % self.request_id)
-                processed_transcript = (yield self.post_process(self.partial_transcript, blocking=True))[0]
+                processed_transcript = (yield self.post_process([self.partial_transcript]))[0]
                 logger.info("%s: Postprocessing done." % self.request_id)
                 event = dict(status=common.STATUS_SUCCESS,
                              segment=self.num_segments,
@@ -320,6 +405,25 @@ class ServerWebsocket(WebSocketClient):
             self._increment_num_processing(-1)
 
 
+    @tornado.gen.coroutine
+    def _on_segment_length(self, segment_length, rtf):
+        # the decoder changed its chunk length to keep up with real time, sent after the results before it
+        previous, sent = self._next_result()
+        try:
+            if previous is not None:
+                yield previous
+            event = dict(status=common.STATUS_SUCCESS,
+                         segment=self.num_segments,
+                         chunk=dict(segment_length=segment_length, rtf=round(rtf, 3)))
+            try:
+                self.send(json.dumps(event))
+            except:
+                e = sys.exc_info()[1]
+                logger.warning("Failed to send event to master: %s" % e)
+        finally:
+            sent.set_result(None)
+            self._increment_num_processing(-1)
+
     def _on_eos(self, data=None):
         logger.debug("[DEBUG][ON_EOS] state = {}".format(self.ID_TO_STATE[self.state]))
         self.last_decoder_message = time.time()
@@ -333,6 +437,8 @@ class ServerWebsocket(WebSocketClient):
         
         logger.debug("[DEBUG][ON_EOSr] state = {}".format(self.ID_TO_STATE[self.state]))
         self.state = self.STATE_FINISHED
+        self.cancel_timers()
+        logger.debug("%s: Timers %s" % (self.request_id, self.timers.stats()))
         self.send_adaptation_state()
         self.close()
         logger.debug("[DEBUG][ON_EOSf] state = {}".format(self.ID_TO_STATE[self.state]))
@@ -340,6 +446,7 @@ class ServerWebsocket(WebSocketClient):
     def _on_error(self, err_msg, err_type = "oov"):
         logger.debug("[DEBUG][ON_Error] state = {}".format(self.ID_TO_STATE[self.state]))
         self.state = self.STATE_FINISHED
+        self.cancel_timers()
         if err_type == "oov":
             event = dict(status=common.STATUS_NOT_ALLOWED, message=err_msg)
         elif err_type == "align":
@@ -375,47 +482,33 @@ class ServerWebsocket(WebSocketClient):
             logger.info("%s: Adaptation state not supported by the decoder, not sending it." % (self.request_id))    
 
     @tornado.gen.coroutine
-    def post_process(self, texts, blocking=False):
+    def post_process(self, texts):
         if self.post_processor:
-            if self.post_processor_lock.acquire(blocking):
-                result = []
-                for text in texts:
-                    self.post_processor.stdin.write("%s\n" % text.encode("utf-8"))
-                    self.post_processor.stdin.flush()
-                    logging.debug("%s: Starting postprocessing: %s"  % (self.request_id, text))
-                    text = yield self.post_processor.stdout.read_until('\n')#.decode("utf-8")
-                    text = text.decode("utf-8")
-                    text = text.strip()
-                    text = text.replace("\\n", "\n")
-                    logging.debug("%s: Postprocessing returned: %s"  % (self.request_id, text))
-                    result.append(text)
-                self.post_processor_lock.release()
-                raise tornado.gen.Return(result)
-            else:
-                logging.debug("%s: Skipping postprocessing since post-processor already in use"  % (self.request_id))
-                raise tornado.gen.Return(None)
+            logging.debug("%s: Starting postprocessing: %s"  % (self.request_id, texts))
+            # the texts are pipelined to the pool, and may be spread over several processes
+            responses = yield [self.post_processor.process(text) for text in texts]
+            result = []
+            for text in responses:
+                text = text.strip()
+                text = text.replace("\\n", "\n")
+                logging.debug("%s: Postprocessing returned: %s"  % (self.request_id, text))
+                result.append(text)
+            raise tornado.gen.Return(result)
         else:
             raise tornado.gen.Return(texts)
             
     @tornado.gen.coroutine
     def post_process_full(self, full_result):
         if self.full_post_processor:
-            self.full_post_processor.stdin.write("%s\n\n" % json.dumps(full_result))
-            self.full_post_processor.stdin.flush()
-            lines = []
-            while True:
-                l = self.full_post_processor.stdout.readline()
-                if not l: break # EOF
-                if l.strip() == "":
-                    break
-                lines.append(l)
-            full_result = json.loads("".join(lines))
+            # the answer is the JSON result followed by an empty line
+            response = yield self.full_post_processor.process(json.dumps(full_result))
+            full_result = json.loads(response)
 
         elif self.post_processor:
             transcripts = []
             for hyp in full_result.get("result", {}).get("hypotheses", []):
                 transcripts.append(hyp["transcript"])
-            processed_transcripts = yield self.post_process(transcripts, blocking=True)
+            processed_transcripts = yield self.post_process(transcripts)
             for (i, hyp) in enumerate(full_result.get("result", {}).get("hypotheses", [])):
                 hyp["original-transcript"] = hyp["transcript"]
                 hyp["transcript"] = processed_transcripts[i]
@@ -444,6 +537,7 @@ def main():
     parser = argparse.ArgumentParser(description='Worker for kaldigstserver')
     parser.add_argument('-u', '--uri', default="ws://localhost:8888/worker/ws/speech", dest="uri", help="Server<-->worker websocket URI")
     parser.add_argument('-f', '--fork', default=1, dest="fork", type=int)
+    parser.add_argument('-s', '--streams', default=None, dest="streams", type=int, help="Number of concurrent streams served by one copy of the model (default: 'streams' in the configuration, or 1)")
     parser.add_argument('-p', '--port', default=8899, dest="port", help="Decoder Server TCP port")
     parser.add_argument('-c', '--conf', dest="conf", help="YAML file with decoder configuration")
     parser.add_argument('-gu', '--grader_url', default="http://localhost:21991/text_grading", dest="grader_url")
@@ -464,14 +558,15 @@ def main():
         logging.config.dictConfig(conf["logging"])
 
     # fork off the post-processors before we load the model into memory
+    ServerWebsocket.io_loop = tornado.ioloop.IOLoop.current()
+    pool_size = conf.get("post-processor-pool-size", 1)
     post_processor = None
     if "post-processor" in conf:
-        STREAM = tornado.process.Subprocess.STREAM
-        post_processor = tornado.process.Subprocess(conf["post-processor"], shell=True, stdin=PIPE, stdout=STREAM)
+        post_processor = PostProcessorPool(conf["post-processor"], pool_size)
 
     full_post_processor = None
     if "full-post-processor" in conf:
-        full_post_processor = Popen(conf["full-post-processor"], shell=True, stdin=PIPE, stdout=PIPE)
+        full_post_processor = PostProcessorPool(conf["full-post-processor"], pool_size, terminator=b"\n\n")
 
     global SILENCE_TIMEOUT
     SILENCE_TIMEOUT = conf.get("silence-timeout", 5)
@@ -482,12 +577,21 @@ def main():
     global DECODER_TIMEOUT
     DECODER_TIMEOUT = conf.get("decoder-timeout", 10)
 
+    streams = args.streams if args.streams is not None else conf.get("streams", 1)
+    # every stream connects to the master as a slot of this process, so the master can count its free slots
+    separator = "&" if urllib.parse.urlparse(args.uri).query else "?"
+    uri = args.uri + separator + urllib.parse.urlencode([("worker-id", str(uuid.uuid4())), ("slots", streams)])
+
     decoder_pipeline = DecoderPipeline(sys_conf=conf, port=args.port, args=args)
 
     loop = GLib.MainLoop()
     thread.start_new_thread(loop.run, ())
-    thread.start_new_thread(tornado.ioloop.IOLoop.instance().start, ())
-    main_loop(args.uri, decoder_pipeline, post_processor, full_post_processor)  
+    thread.start_new_thread(ServerWebsocket.io_loop.start, ())
+    # the other streams share the loaded model, each with its own session and master connection
+    for _ in range(streams - 1):
+        stream_pipeline = DecoderPipeline(sys_conf=conf, port=args.port, args=args, speech2text=decoder_pipeline.speech2text)
+        thread.start_new_thread(main_loop, (uri, stream_pipeline, post_processor, full_post_processor))
+    main_loop(uri, decoder_pipeline, post_processor, full_post_processor)  
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,106 @@
+import pytest
+import torch
+
+from local.whispergstserver.simul_whisper.transcriber import simul_whisper
+from local.whispergstserver.simul_whisper.transcriber.backend import InferenceBackend
+from local.whispergstserver.simul_whisper.transcriber.config import AlignAttConfig
+from local.whispergstserver.simul_whisper.whisper import tokenizer
+from local.whispergstserver.simul_whisper.whisper.audio import N_FFT, HOP_LENGTH, SAMPLE_RATE
+from local.whispergstserver.simul_whisper.whisper.model import KVCache, ModelDimensions
+
+WORDS = tokenizer.get_tokenizer(multilingual=True, language="en", task="transcribe").encode(" one two three four five six seven")
+
+
+class PositionalBackend(InferenceBackend):
+    """
+    A decoder whose output for a token only depends on its position: the next token is a word of WORDS and
+    the alignment heads attend around frame 4 * position. Reusing cached keys/values is exact for it.
+    """
+    def __init__(self):
+        self.dims = ModelDimensions(n_mels=80, n_audio_ctx=1500, n_audio_state=8, n_audio_head=1, n_audio_layer=1,
+                                    n_vocab=51865, n_text_ctx=448, n_text_state=8, n_text_head=2, n_text_layer=2)
+        self.alignment_heads = torch.tensor([[False, True], [True, False]]).to_sparse()
+        self.device = torch.device("cpu")
+        self.n_fed = 0
+
+    def encode(self, mel):
+        return torch.zeros(mel.shape[0], mel.shape[2] // 2, self.dims.n_audio_state)
+
+    def new_kv_cache(self, n_ctx):
+        return KVCache(n_ctx)
+
+    def decode(self, tokens, audio_features, kv_cache):
+        positions = torch.arange(kv_cache.offset, kv_cache.offset + tokens.shape[1])
+        kv_cache.advance(tokens.shape[1])
+        self.n_fed += tokens.shape[1]
+        logits = torch.full((1, tokens.shape[1], self.dims.n_vocab), -10.0)
+        logits[0, torch.arange(tokens.shape[1]), torch.tensor(WORDS)[positions % len(WORDS)]] = 10.0
+        frames = torch.arange(audio_features.shape[1])
+        weights = torch.exp(-((frames[None, :] - 4 * positions[:, None]) / 2.0) ** 2)
+        weights = (weights / weights.sum(dim=-1, keepdim=True)).expand(1, self.dims.n_text_head, -1, -1)
+        return logits, [(layer_rank, weights) for layer_rank in self.align_layers()]
+
+
+def decode_stream(monkeypatch, tmp_path, **options):
+    torch.manual_seed(0)
+    backend = PositionalBackend()
+    monkeypatch.setattr(simul_whisper, "load_backend", lambda cfg: backend)
+    torch.save(torch.nn.Linear(backend.dims.n_audio_state, 1).state_dict(), tmp_path / "cif.pt")
+    cfg = AlignAttConfig(model_path="positional", if_ckpt_path=str(tmp_path / "cif.pt"), language="en",
+                         frame_threshold=12, min_seg_len=0.0, **options)
+    model = simul_whisper.PaddedAlignAttWhisper(cfg)
+    session = model.new_session()
+
+    audio = 0.1 * torch.randn(6 * SAMPLE_RATE)
+    step = SAMPLE_RATE
+    events = []
+    for start in range(0, audio.shape[0], step):
+        chunk = audio[max(0, start - (N_FFT - HOP_LENGTH)) : start + step]
+        model.infer(session, chunk, is_last=start + step >= audio.shape[0], on_token=events.append)
+    return events, backend.n_fed
+
+
+@pytest.mark.parametrize("truncate_encoder", [False, True])
+def test_reuse_prefix_kv_keeps_tokens_and_frames(monkeypatch, tmp_path, truncate_encoder):
+    events, n_fed = decode_stream(monkeypatch, tmp_path, truncate_encoder=truncate_encoder)
+    reused_events, reused_n_fed = decode_stream(monkeypatch, tmp_path, truncate_encoder=truncate_encoder, reuse_prefix_kv=True)
+
+    assert sum(event.committed for event in events) > len(WORDS)
+    assert [(e.token, e.frame, e.committed) for e in reused_events] == [(e.token, e.frame, e.committed) for e in events]
+    assert reused_n_fed < n_fed
+
+
+def resize_loop(alphas, target_lengths, threshold=0.999):
+    """PaddedAlignAttWhisper.resize before it was vectorized"""
+    _num = alphas.sum(-1)
+    num = target_lengths.float()
+    _alphas = alphas * (num / _num)[:, None].repeat(1, alphas.size(1))
+    count = 0
+    while len(torch.where(_alphas > threshold)[0]):
+        count += 1
+        if count > 10:
+            break
+        xs, ys = torch.where(_alphas > threshold)
+        for x, y in zip(xs, ys):
+            if _alphas[x][y] >= threshold:
+                mask = _alphas[x].ne(0).float()
+                mean = 0.5 * _alphas[x].sum() / mask.sum()
+                _alphas[x] = _alphas[x] * 0.5 + mean * mask
+    return _alphas, _num
+
+
+def test_resize_matches_loop_on_rows_with_several_peaks():
+    torch.manual_seed(0)
+    alphas = torch.rand(16, 40) * 0.3
+    alphas[:, 30:] = 0 # padding frames stay zero
+    for row in range(12):
+        # one to four peaks, some so high that they still exceed the threshold after ten passes
+        peaks = torch.randperm(30)[: row % 4 + 1]
+        alphas[row, peaks] = 10.0 ** (4 * torch.rand(peaks.shape[0]))
+    target_lengths = torch.round(alphas.sum(-1)).int()
+
+    expected, expected_num = resize_loop(alphas, target_lengths)
+    resized, num = simul_whisper.PaddedAlignAttWhisper.resize(None, alphas, target_lengths)
+
+    assert torch.equal(num, expected_num)
+    assert torch.allclose(resized, expected, rtol=1e-6, atol=1e-6)